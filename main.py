@@ -1,9 +1,11 @@
-import os, subprocess, argparse
-from sys import stderr, stdout
-from src.python.life_table import generate_life_table
-from src.python.country_table import generate_country_table
-from src.python.helper import DOWNLOAD_FOLDER as raw, OUTPUT_FOLDER as processed, R_PATH, SETTINGS
-from src.python import log  
+import os, sys, shutil, subprocess, argparse
+from src.python.life_table import write_life_table
+from src.python.country_table import write_country_table, merge_metric_tables, metrics_engine
+from src.python.helper import DOWNLOAD_FOLDER as raw, OUTPUT_FOLDER as processed, get_settings, get_out_path
+from src.python.table_io import EXTENSIONS, output_format, read_table, previous_table
+from src.python.panel_store import panel_folder
+from src.python.scheduler import Stage
+from src.python import log, download, hmd, hfd, hg, income_status, stage_cache, instrument, scheduler, r_worker
     
 
 life_table_derivatives_R = "src/R/life_table_derivatives.R"
@@ -14,26 +16,20 @@ plots_Ne_T_by_group_R = "src/R/plots_Ne_T_by_group.R"
 out_dir = "outputs"
 
 
-def run_r(path: str, *args: str):
-    version = SETTINGS["r_version"]
-
-    # find correct OS to run the r from
-    try: # MacOS
-        cmd = ["Rscript", path, *map(str, args)]
-        res = subprocess.run(cmd,capture_output=True, text=True)
-        log.log(f"ran R (MacOS): {path}")
-    except: 
-        try: # Win 64
-            rscript_path = fr"C:\Program Files\R\{version}\bin\Rscript"
-            cmd = [rscript_path, "--vanilla", path, *map(str, args)]
-            res = subprocess.run(cmd, capture_output=True, text=True, shell=True)
-            log.log(f"ran R (Win x64): {path}")
-        except: # Win 86
-            rscript_path = fr"C:\Program Files (x86)\R\{version}\bin\Rscript"
-            cmd = [rscript_path, "--vanilla", path, *map(str, args)]
-            res = subprocess.run(cmd, capture_output=True, text=True, shell=True)
-            log.log(f"ran R (Win x86): {path}")
-    
+def run_r(path: str, *args: str, share: str = None):
+    # in a persistent R worker (src/R/worker.R), or a fresh Rscript per script with r_worker: false;
+    # scripts with the same share key run in the same worker (see r_worker.run_script)
+    if get_settings().get("r_worker", True):
+        result = r_worker.run_script(path, *args, share=share)
+        if result.output:
+            log.log("\n".join(result.output))
+        log.log(f"ran R: {path} ({result.seconds:.2f}s in the R worker)")
+        if not result.ok:
+            log.error(f"R script failed: {os.path.basename(path)}: {result.error}")
+        return
+
+    res = subprocess.run([r_worker.rscript(), path, *map(str, args)], capture_output=True, text=True)
+    log.log(f"ran R: {path}")
     if res.stdout:
         log.log(res.stdout.strip())
     if res.stderr: # apparently some R packages write informative messages to stderr, so logging them to log.log, not to log.error
@@ -42,69 +38,172 @@ def run_r(path: str, *args: str):
         log.error(f"R script failed: {os.path.basename(path)} (exit {res.returncode}). [R stderr] {res.stderr.strip()}")
 
 
-if __name__ == "__main__":
-    #debug
-    import os
-    log.log(f"Python is running from: {os.getcwd()}")
-    log.log(f"ShinyPipeline.R exists here: {os.path.exists('ShinyPipeline.R')}")
-    
-    
+# the R metric scripts add their columns to a copy of the country table they are given (output), a step is
+# reused while the tables it reads and the script are unchanged. they all read the life table, so they share
+# the worker that keeps it (one at a time) instead of each reading it in a worker of its own
+def run_r_metric(path: str, life_table_path: str, country_table_path: str, output: str):
+    stage = os.path.splitext(os.path.basename(path))[0]
+    key = stage_cache.stage_key(stage, stage_cache.hash_path(life_table_path), stage_cache.hash_path(country_table_path),
+                                sources=(path, "src/R/table_io.R"))
+    stage_cache.cached_file(stage, key, output, lambda: run_r(path, life_table_path, country_table_path, output, share=life_table_path))
+    return output
+
+
+# R metric scripts and the country table each one extends: only ne_felsenstein needs generation_time's T,
+# the others run next to it and r_metrics merges their columns into the python table (country_table_python)
+R_METRICS = {
+    generation_time_R: "country_table_python_path",
+    ne_felsenstein_R: "country_table_generation_time_path",
+    "src/R/mx_shape_metrics.R": "country_table_python_path",
+    "src/R/prr_calculation.R": "country_table_python_path",
+}
+
+
+def r_metric_stage(path: str, country_input: str) -> Stage:
+    name = os.path.splitext(os.path.basename(path))[0]
+    output = f"country_table_{name}"
+    def run(life_table_path, **country):
+        return run_r_metric(path, life_table_path, country[country_input],
+                            os.path.join(get_out_path(), output + EXTENSIONS[output_format()]))
+    return Stage(name, run, inputs=("life_table_path", country_input), outputs=(output + "_path",))
+
+
+def merge_r_metrics(country_table_python_path, country_table_ne_felsenstein_path,
+                    country_table_mx_shape_metrics_path, country_table_prr_calculation_path) -> str:
+    # ne_felsenstein's table also has generation_time's T
+    return merge_metric_tables(country_table_python_path, [country_table_ne_felsenstein_path,
+                                                           country_table_mx_shape_metrics_path,
+                                                           country_table_prr_calculation_path])
+
+
+def pipeline_stages() -> list:
+    '''
+    stages of a run in dependency order; artifacts are named after the table they are written as
+    (<name>_df: a dataframe, <name>_path: the path of the written table)
+    '''
+    # with the R engine the python stages write country_table_python (H_N only) and r_metrics the country table
+    country_table = "country_table_python" if metrics_engine() == "r" else "country_table"
+    stages = [
+        # sources are independent, they load concurrently
+        Stage("hmd", lambda: hmd.generate_hmd_df(False), outputs=("hmd_df",)),
+        Stage("hfd", lambda: hfd.generate_hfd_df(False), outputs=("hfd_df",)),
+        Stage("hg", hg.generate_hg_df, outputs=("hg_df",)),
+        Stage("income_status", lambda: income_status.generate_income_status_df(False)[0], outputs=("income_status_df",)),
+        Stage("life_table", write_life_table, inputs=("hmd_df", "hfd_df", "hg_df"), outputs=("life_table_path",)),
+        Stage("country_table", lambda life_table_path, income_status_df: write_country_table(life_table_path, income_status_df, country_table),
+              inputs=("life_table_path", "income_status_df"), outputs=(country_table + "_path",)),
+    ]
+
+    # fields like dx, sx, vx etc... are computed in python by write_life_table (life_table_derivatives_R kept as a cross-check)
+    if metrics_engine() == "r":
+        stages += [r_metric_stage(path, country_input) for path, country_input in R_METRICS.items()]
+        stages.append(Stage("r_metrics", merge_r_metrics, inputs=(
+            "country_table_python_path", "country_table_ne_felsenstein_path",
+            "country_table_mx_shape_metrics_path", "country_table_prr_calculation_path"), outputs=("country_table_path",)))
+    return stages
+
+
+def load_previous(artifact: str):
+    '''
+    an input of the selected stages that none of them produces, from the latest earlier run that wrote it:
+    dataframes are read back, tables are copied into this run's folder so it stays complete for Shiny
+    '''
+    name = artifact.rsplit("_", 1)[0]
+    path = previous_table(name)
+    if path is None: log.error(f"no earlier run has the {name} table, run the stages that produce {artifact} first")
+    log.log(f"using {name} from an earlier run: {path}")
+
+    if artifact.endswith("_df"): return read_table(path)
+    copied = shutil.copy(path, get_out_path())
+    if name == "life_table" and os.path.isdir(panel_folder(path)): # its binary panel, read by the country table stage
+        shutil.copytree(panel_folder(path), panel_folder(copied))
+    return copied
+
+
+def main():
+    # arguments first: the first log message creates this run's data folder, --help and usage errors must not
     parser = argparse.ArgumentParser()
     parser.add_argument("--download", action="store_true", help="Download data")
+    parser.add_argument("--profile", action="store_true", help="Profile the python stages (cProfile + tracemalloc, written to <data folder>/profile), stages run one at a time")
+    selection = parser.add_mutually_exclusive_group()
+    selection.add_argument("--only", help="Run only these stages (comma separated), inputs from other stages are taken from the latest earlier run")
+    selection.add_argument("--from", dest="start", help="Run this stage and every stage downstream of it")
     args = parser.parse_args()
 
+    #debug
+    log.log(f"Python is running from: {os.getcwd()}")
+    log.log(f"ShinyPipeline.R exists here: {os.path.exists('ShinyPipeline.R')}")
+
+    if args.profile: instrument.enable_profiling()
+
     # make sure folders exist
     for p in (raw, processed, "outputs"):
         os.makedirs(p, exist_ok=True)
 
-    # python prep
-    log.log("=== python pipeline: start ===")
-    life_table_path = generate_life_table(args.download)
-    country_table_path = generate_country_table(life_table_path, args.download)
-    log.log("=== python pipeline: done ===")
-
-    # r analysis
-    log.log("=== r pipeline: start ===")
-
-    # generate data
-    run_r(life_table_derivatives_R, life_table_path) # compute fields like dx, sx, qx etc...
-    run_r(generation_time_R, life_table_path, country_table_path) # calculation generation time
-    run_r(ne_felsenstein_R, life_table_path, country_table_path) # calculate Ne according to felsenstein
-    run_r("src/R/mx_shape_metrics.R", life_table_path, country_table_path) #calculate mx with skew
-    run_r("src/R/prr_calculation.R", life_table_path, country_table_path)
+    # download phase, sources are independent so they are fetched concurrently
+    if args.download:
+        with instrument.stage("download"):
+            download.download_all({
+                "HMD": hmd.download_hmd,
+                "HFD": hfd.download_hfd,
+                "WBLG": income_status.download_income_status,
+            })
+
+    # python prep and r analysis, each stage starts once its inputs are there
+    stages = scheduler.select(pipeline_stages(), args.only.split(",") if args.only else None, args.start)
+    log.log("=== pipeline: " + ", ".join(s.name for s in stages) + " ===")
+    if metrics_engine() != "r":
+        log.log("metrics computed in python (set metrics_engine: \"r\" in settings.json5 to run the R scripts)")
+    artifacts = {a: load_previous(a) for a in scheduler.missing_inputs(stages)}
+
+    # profiles are per stage, so stages are not overlapped while profiling
+    scheduler.run(stages, artifacts, workers=1 if args.profile else None)
+    r_worker.stop()
+    log.log("=== pipeline: done ===")
+
+    # a run of selected stages may not have produced the tables the app reads
+    if not any(os.path.exists(os.path.join(get_out_path(), "country_table" + ext)) for ext in EXTENSIONS.values()):
+        log.log("no country table in this run's folder, not starting Shiny")
+        return
+
     # plot data; had to get rid of run r as r needs to keep running for r shiny
     
     log.log(f"SHINY_DATA_DIR is set to: {processed}")
 
 
-    latest_data_directory = os.path.dirname(life_table_path)
+    latest_data_directory = get_out_path()
     os.environ["SHINY_DATA_DIR"] = latest_data_directory
     log.log(f"SHINY_DATA_DIR is set to: {latest_data_directory}")
     import webbrowser #using Popen isntead of run; lets Rshiny keep running
     import time
 
-    log.log("population project V1.0 starting...")
-    shiny_process =subprocess.Popen(
-        ["Rscript","ShinyPipeline.R"],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        text=True,
-        bufsize=1 #buffered line
-    )
-
-    time.sleep(5)
-   
-    if shiny_process.poll() is not None:
-        log.error(f"Shiny crashed Exit code {shiny_process.returncode}")
-        log.error(f"R stdout: {stdout}")
-        log.error(f"R stderr: {stderr}")
-
-    else:
-        log.log("Shiny process is running!")
-        webbrowser.open("http://127.0.0.1:7398")
-        log.log("Press Ctrl=c in the treminal to stop the app")
-        shiny_process.wait()
-
-log.log("== r pipeline: done ==")
-   
+    with log.stage("shiny"):
+        log.log("population project V1.0 starting...")
+        shiny_process =subprocess.Popen(
+            [r_worker.rscript(),"ShinyPipeline.R"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+            bufsize=1 #buffered line
+        )
+
+        time.sleep(5)
+       
+        if shiny_process.poll() is not None:
+            out, err = shiny_process.communicate()
+            log.error(f"Shiny crashed Exit code {shiny_process.returncode}\nR stdout: {out}\nR stderr: {err}")
 
+        else:
+            log.log("Shiny process is running!")
+            webbrowser.open("http://127.0.0.1:7398")
+            log.log("Press Ctrl=c in the treminal to stop the app")
+            shiny_process.wait()
+
+    log.log("== r pipeline: done ==")
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except log.PipelineError: # already logged
+        sys.exit(1)
@@ -0,0 +1,318 @@
+import os, sys, json, shutil, string, zipfile, argparse, tempfile, subprocess
+import numpy as np
+import pandas as pd
+import json5
+from src.python.helper import SETTINGS_FILE, R_PATH, get_datetimestamp
+
+
+# offline benchmark of the pipeline on synthetic data shaped like the real downloads:
+# HMD lt_female.zip (fltper_1x1, PopName Year Age mx qx ax lx dx Lx Tx ex), HFD asfr.zip (asfrRR.txt, Code Year Age ASFR),
+# the HG csv files and the WBLG workbook. every scale gets its own working folder under the benchmark folder
+# (outside the repository by default, the data is several GB at the larger scales), the pipeline runs there in a
+# fresh process and its run_metrics.json (src/python/instrument.py) is appended with the git commit to
+# <benchmark folder>/results.jsonl, so runs of different commits can be compared.
+# --engine r runs the stages of main.py with metrics_engine "r", timing each R metric script (needs Rscript)
+#
+#   python -m src.python.benchmark --populations 50 500 5000 --years 10
+#   python -m src.python.benchmark --populations 5000 --workers 1 2 4 8   (metrics speedup per worker count)
+#   python -m src.python.benchmark --populations 500 --engine r
+#   python -m src.python.benchmark --folder /scratch/benchmark
+
+BENCHMARK_FOLDER = os.path.join(tempfile.gettempdir(), "population-benchmark")
+RESULTS_FILE = "results.jsonl"
+
+DEFAULT_POPULATIONS = [50, 500, 5000]
+DEFAULT_YEARS = 10
+FIRST_YEAR = 2000 # inside the WBLG income group years (1987-)
+HFD_YEAR_SHIFT = 2 # HFD series start a little later, so not every HMD country-year has fertility data
+
+HMD_AGES = np.arange(0, 111) # 0 ... 110+
+HFD_AGES = np.arange(12, 56) # 12- ... 55+
+ISO3_POOL = 200 # distinct ISO3 codes (the WBLG sheet holds at most 218 countries), further populations get a suffix
+
+HMD_HEADER = ("Life tables (period 1x1), Females\tLast modified: 01 Jan 2025;  Methods Protocol: v6 (2017)\n\n"
+              "   PopName  Year   Age         mx       qx    ax      lx      dx      Lx       Tx     ex\n")
+HFD_HEADER = ("Age-specific fertility rate by calendar year and age (period), Registered births, Resident mothers"
+              "\tLast modified: 01 Jan 2025;  Methods Protocol: v6 (2017)\n\n"
+              "   Code  Year     Age     ASFR\n")
+
+SCALING_PREFIX = "SCALING " # marks the result line in the scaling child's output
+
+HG_FILES = ["Ache - Hurtado & Hill.csv", "Hadza - Blurton Jones data.csv", "!Kung - data.csv"]
+
+
+def population_codes(n: int) -> list:
+    ''' HxD style population codes: ISO3 (AAB, AAC, ...) followed by a suffix once the ISO3 pool is used up '''
+    letters = string.ascii_uppercase
+    def letter_code(i, width): return "".join(letters[(i // 26 ** k) % 26] for k in reversed(range(width)))
+    return [letter_code(i % ISO3_POOL + 1, 3) + ("" if i < ISO3_POOL else letter_code(i // ISO3_POOL, 2)) for i in range(n)]
+
+
+def age_labels(ages: np.ndarray, open_start: bool) -> list:
+    labels = [str(a) for a in ages]
+    if open_start: labels[0] += "-"
+    labels[-1] += "+"
+    return labels
+
+
+def hmd_lines(code: str, years: np.ndarray, rng) -> str:
+    ''' female period life tables from a Gompertz-Makeham hazard that declines over the years '''
+    a = rng.uniform(2e-5, 8e-5) * np.exp(-0.01 * (years - years[0]))[:, None]
+    hazard = rng.uniform(2e-4, 8e-4) + a * np.exp(rng.uniform(0.085, 0.11) * HMD_AGES)[None, :]
+    qx = np.clip(1 - np.exp(-hazard), 0, 1)
+    qx[:, 0] = rng.uniform(0.003, 0.06)
+    qx[:, -1] = 1
+
+    lx = np.round(100000 * np.cumprod(np.hstack([np.ones((len(years), 1)), 1 - qx[:, :-1]]), axis=1))
+    dx = np.round(lx * qx)
+    ax = np.full_like(qx, 0.5)
+    ax[:, 0] = 0.15
+    Lx = np.round(lx - (1 - ax) * dx)
+    Tx = np.cumsum(Lx[:, ::-1], axis=1)[:, ::-1]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mx = np.where(Lx > 0, dx / Lx, 0)
+        ex = np.where(lx > 0, Tx / lx, 0)
+
+    labels = age_labels(HMD_AGES, open_start=False)
+    return "".join(
+        f"   {code:<7}{year:>6}{labels[j]:>6}{mx[i, j]:>11.6f}{qx[i, j]:>9.6f}{ax[i, j]:>6.2f}"
+        f"{int(lx[i, j]):>8d}{int(dx[i, j]):>8d}{int(Lx[i, j]):>8d}{int(Tx[i, j]):>9d}{ex[i, j]:>7.2f}\n"
+        for i, year in enumerate(years) for j in range(len(HMD_AGES)))
+
+
+def hfd_lines(code: str, years: np.ndarray, rng) -> str:
+    ''' age specific fertility as a normal curve around the mean age at birth, scaled to a total fertility rate '''
+    tfr = rng.uniform(1.2, 3.0) * np.exp(-0.01 * (years - years[0]))[:, None]
+    mean_age, sd = rng.uniform(25, 31), rng.uniform(4.5, 6.5)
+    curve = np.exp(-0.5 * ((HFD_AGES - mean_age) / sd) ** 2)
+    asfr = tfr * curve[None, :] / curve.sum()
+
+    labels = age_labels(HFD_AGES, open_start=True)
+    return "".join(
+        f"   {code:<7}{year:>6}{labels[j]:>8}{asfr[i, j]:>9.5f}\n"
+        for i, year in enumerate(years) for j in range(len(HFD_AGES)))
+
+
+def write_archive(path: str, member: str, header: str, blocks):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with zipfile.ZipFile(path + ".tmp", "w", compression=zipfile.ZIP_DEFLATED) as z:
+        with z.open(member, "w") as f:
+            f.write(header.encode())
+            for block in blocks: f.write(block.encode())
+    os.replace(path + ".tmp", path)
+
+
+def write_hg(folder: str, rng):
+    os.makedirs(folder, exist_ok=True)
+    ages = np.arange(0, 86)
+    for name in HG_FILES:
+        lx = np.cumprod(np.r_[1, np.full(len(ages) - 1, 1 - rng.uniform(0.015, 0.03))])
+        mx = np.where((ages >= 14) & (ages < 50), 0.15 * np.exp(-0.5 * ((ages - rng.uniform(25, 30)) / 7) ** 2), np.nan)
+        pd.DataFrame({"Age": ages, "lx": lx.round(5), "mx": mx.round(5)}).to_csv(os.path.join(folder, name), index=False)
+
+
+def write_wblg(path: str, iso3: list):
+    ''' "Country Analytical History" sheet in the layout format_income_status slices (rows 4..227 under the title row) '''
+    years = list(range(1987, 2024))
+    groups = np.array(["L", "LM", "UM", "H", ".."])
+    blank = ["", ""] + [""] * len(years)
+    rows = [["World Bank Analytical Classifications"] + blank[1:]] + [blank] * 4 + [["ISO3", "Country"] + years] + [blank] * 5
+    rows += [[code, f"Country {code}"] + list(groups[(i + np.arange(len(years)) // 9) % len(groups)]) for i, code in enumerate(iso3)]
+    rows += [blank] * max(0, 240 - len(rows))
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    pd.DataFrame(rows).to_excel(path, sheet_name="Country Analytical History", index=False, header=False)
+
+
+def generate_dataset(folder: str, populations: int, years: int, seed: int = 0):
+    '''
+    write data/raw under folder for the given number of populations and years (kept for reuse across runs)
+    '''
+    marker = os.path.join(folder, "dataset.json")
+    spec = {"populations": populations, "years": years, "seed": seed, "first_year": FIRST_YEAR}
+    if os.path.exists(marker):
+        with open(marker) as f:
+            if json.load(f) == spec: return
+
+    rng = np.random.default_rng(seed)
+    codes = population_codes(populations)
+    hmd_years = np.arange(FIRST_YEAR, FIRST_YEAR + years)
+    hfd_years = hmd_years + HFD_YEAR_SHIFT
+    raw = os.path.join(folder, "data", "raw")
+
+    print(f"generating {populations} populations x {years} years in {folder}")
+    write_archive(os.path.join(raw, "HMD", "lt_female.zip"), "lt_female/fltper_1x1/fltper_1x1.txt", HMD_HEADER,
+                  (hmd_lines(code, hmd_years, rng) for code in codes))
+    write_archive(os.path.join(raw, "HFD", "asfr.zip"), "asfrRR.txt", HFD_HEADER,
+                  (hfd_lines(code, hfd_years, rng) for code in codes))
+    write_hg(os.path.join(raw, "HG"), rng)
+    write_wblg(os.path.join(raw, "WBLG", "WorldBank_Country_LendingGroups.xlsx"), sorted({c[:3] for c in codes}))
+
+    with open(marker, "w") as f:
+        json.dump(spec, f)
+
+
+def write_settings(folder: str, engine: str = "python"):
+    ''' the repository settings, with the stage cache off so every stage is measured, and the metrics engine '''
+    with open(SETTINGS_FILE) as f:
+        settings = json5.load(f)
+    settings["stage_cache"] = False
+    settings["metrics_engine"] = engine
+    with open(os.path.join(folder, SETTINGS_FILE), "w") as f:
+        json.dump(settings, f, indent=2)
+
+
+def copy_r_scripts(folder: str):
+    ''' the R scripts of this checkout into folder, main.py and the scripts source them relative to the working directory '''
+    shutil.copytree(R_PATH, os.path.join(folder, R_PATH), dirs_exist_ok=True)
+
+
+def run_pipeline(engine: str = "python"):
+    ''' entry point of the benchmark child process (working directory = the scale's folder) '''
+    if engine == "r":
+        # the stage graph of main.py, with metrics_engine "r" it ends in the R metric scripts and r_metrics
+        import main
+        from src.python import scheduler, r_worker
+        scheduler.run(main.pipeline_stages())
+        r_worker.stop()
+        return
+
+    from src.python.life_table import generate_life_table
+    from src.python.country_table import generate_country_table
+    generate_country_table(generate_life_table())
+
+
+def run_scaling(worker_counts: list):
+    ''' entry point of the scaling child process: time the metrics of the last run's life table per worker count '''
+    import glob, time
+    from src.python.country_table import load_life_table
+    from src.python.metrics import PANEL_COLUMNS, calculate_metrics_for_panel, calculate_metrics_sharded
+    from src.python.panel import build_panel
+
+    # located before anything is logged, logging allocates a new run folder
+    life_table_path = glob.glob(os.path.join(latest_run_folder("."), "life_table.*"))[0]
+    panel = build_panel(load_life_table(life_table_path), columns=PANEL_COLUMNS)
+
+    timings = {}
+    for n in worker_counts:
+        start = time.perf_counter()
+        if n == 1: calculate_metrics_for_panel(panel)
+        else: calculate_metrics_sharded(panel, n_workers=n)
+        timings[n] = round(time.perf_counter() - start, 3)
+    print(SCALING_PREFIX + json.dumps({"country_years": len(panel), "wall_s": timings}), flush=True)
+
+
+def latest_run_folder(folder: str) -> str:
+    processed = os.path.join(folder, "data", "processed")
+    runs = [e.name for e in os.scandir(processed) if e.is_dir() and e.name.startswith("data")]
+    return os.path.join(processed, max(runs, key=lambda name: int(name[4:])))
+
+
+def git_commit() -> str:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], capture_output=True, text=True).stdout.strip()
+        return commit + ("-dirty" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def scale_folder(root: str, populations: int, years: int) -> str: return os.path.join(root, f"{populations}x{years}")
+
+
+def run_child(folder: str, code: str) -> str:
+    ''' run python code in a fresh process inside folder, returns its stdout '''
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join(filter(None, [os.getcwd(), os.environ.get("PYTHONPATH")]))}
+    res = subprocess.run([sys.executable, "-c", code], cwd=folder, env=env, capture_output=True, text=True)
+    if res.returncode != 0:
+        sys.exit(f"benchmark run failed in {folder}:\n{res.stdout[-2000:]}\n{res.stderr[-2000:]}")
+    return res.stdout
+
+
+def benchmark(root: str, populations: int, years: int, seed: int = 0, engine: str = "python") -> dict:
+    folder = scale_folder(root, populations, years)
+    generate_dataset(folder, populations, years, seed)
+    write_settings(folder, engine)
+    if engine == "r": copy_r_scripts(folder)
+    run_child(folder, f"from src.python.benchmark import run_pipeline; run_pipeline({engine!r})")
+
+    with open(os.path.join(latest_run_folder(folder), "run_metrics.json")) as f:
+        metrics = json.load(f)
+
+    return {
+        "date": get_datetimestamp(),
+        "commit": git_commit(),
+        "populations": populations,
+        "years": years,
+        "seed": seed,
+        "engine": engine,
+        "stages": {s["stage"]: {k: s[k] for k in ("wall_s", "cpu_s", "children_cpu_s", "overlapped", "peak_rss_mb", "rows_in", "rows_out") if k in s} for s in metrics["stages"]},
+    }
+
+
+def scaling(root: str, populations: int, years: int, worker_counts: list) -> dict:
+    ''' metrics wall time and speedup per worker count, on the life table of the last benchmark run of the scale '''
+    out = run_child(scale_folder(root, populations, years), f"from src.python.benchmark import run_scaling; run_scaling({list(worker_counts)})")
+    measured = json.loads(next(line for line in out.splitlines() if line.startswith(SCALING_PREFIX))[len(SCALING_PREFIX):])
+    base = measured["wall_s"].get("1")
+
+    print(f"\nmetrics scaling, {measured['country_years']} country-years ({os.cpu_count()} cpus)")
+    for n, wall in measured["wall_s"].items():
+        print(f"  {n:>3} workers{wall:>9.2f}s" + (f"   {base / wall:>5.2f}x" if base else ""))
+
+    return {
+        "date": get_datetimestamp(),
+        "commit": git_commit(),
+        "populations": populations,
+        "years": years,
+        "cpus": os.cpu_count(),
+        "scaling": {n: {"wall_s": wall, "speedup": round(base / wall, 2) if base else None} for n, wall in measured["wall_s"].items()},
+    }
+
+
+def previous_result(results_file: str, populations: int, years: int, engine: str = "python"):
+    if not os.path.exists(results_file): return None
+    with open(results_file) as f:
+        results = [json.loads(line) for line in f if line.strip()]
+    matching = [r for r in results if "stages" in r and r["populations"] == populations and r["years"] == years
+                and r.get("engine", "python") == engine] # results from before --engine are python runs
+    return matching[-1] if matching else None
+
+
+def report(result: dict, previous: dict):
+    print(f"\n{result['populations']} populations x {result['years']} years, {result['engine']} metrics (commit {result['commit']})")
+    if previous: print(f"  compared with commit {previous['commit']} ({previous['date']})")
+    for name, stage in result["stages"].items():
+        cpu = stage["cpu_s"] + (stage.get("children_cpu_s") or 0) # thread and child processes
+        line = f"  {name:<16}{stage['wall_s']:>9.2f}s wall{cpu:>9.2f}s cpu"
+        if stage["peak_rss_mb"] is not None: line += f"{stage['peak_rss_mb']:>9.0f} MB"
+        before = previous["stages"].get(name) if previous else None
+        if before and before["wall_s"]:
+            line += f"   {stage['wall_s'] / before['wall_s']:>6.2f}x"
+        if stage.get("overlapped"): line += "   (overlapped)"
+        print(line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmark the pipeline on synthetic HMD/HFD shaped data")
+    parser.add_argument("--populations", type=int, nargs="+", default=DEFAULT_POPULATIONS, help="scales to run")
+    parser.add_argument("--years", type=int, default=DEFAULT_YEARS, help="years per population")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, nargs="*", help="also time the metrics with these worker counts (e.g. 1 2 4 8)")
+    parser.add_argument("--engine", choices=["python", "r"], default="python", help="metrics engine (r: the R metric scripts, needs Rscript)")
+    parser.add_argument("--folder", default=BENCHMARK_FOLDER, help=f"datasets, runs and results.jsonl (default: {BENCHMARK_FOLDER})")
+    args = parser.parse_args()
+
+    os.makedirs(args.folder, exist_ok=True)
+    results_file = os.path.join(args.folder, RESULTS_FILE)
+    for populations in args.populations:
+        previous = previous_result(results_file, populations, args.years, args.engine)
+        result = benchmark(args.folder, populations, args.years, args.seed, args.engine)
+        report(result, previous)
+        with open(results_file, "a") as f:
+            f.write(json.dumps(result) + "\n")
+
+        if args.workers:
+            result = scaling(args.folder, populations, args.years, args.workers)
+            with open(results_file, "a") as f:
+                f.write(json.dumps(result) + "\n")
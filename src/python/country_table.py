@@ -1,68 +1,115 @@
-import os
 import pandas as pd
-from src.python import income_status, log
-from src.python.helper import SETTINGS, OUT_PATH
-from src.python.Keyfitz_entropy import calculate_H_for_dataset
+from src.python import income_status, log, stage_cache, metrics, panel, panel_store, population, Keyfitz_entropy, schema, life_table_derivatives, instrument
+from src.python.helper import get_settings
+from src.python.table_io import read_table, write_table
+from src.python.metrics import calculate_panel_metrics, METRIC_COLUMNS, PANEL_COLUMNS
+from src.python.panel import build_panel
+from src.python.panel_store import open_panel_store
+from src.python.population import PopulationIndex, index_populations
+from src.python.schema import apply_schema, LIFE_TABLE_SCHEMA, COUNTRY_TABLE_SCHEMA
 
 
-def load_life_table(life_table_path): return pd.read_csv(life_table_path, engine="python")
+# "python" computes every metric in process, "r" leaves all but H_N to the R scripts (cross-check mode)
+def metrics_engine() -> str: return get_settings().get("metrics_engine", "python")
 
 
-def format_country_table(income_status_df: pd.DataFrame, life_table_df: pd.DataFrame):
+def load_life_table(life_table_path, columns=None): return read_table(life_table_path, columns=columns, dtype=LIFE_TABLE_SCHEMA)
+
+
+def format_country_table(income_status_df: pd.DataFrame, populations: PopulationIndex):
     '''
-    format the income status table for WBLG so that it only filters for countries also in the life table
+    format the income status table for WBLG so that it only filters for countries also in the life table:
+    one row per country-year of the life table's registry, indexed by cy_id (sorted by key)
     '''
-    inc = income_status_df.copy()
-    life = life_table_df.copy()
-
-    # make sure ISO3 all upper case
-    inc["ISO3"] = inc["ISO3"].astype(str).str.upper().str.strip()
-    life["ISO3"] = life["ISO3"].astype(str).str.upper().str.strip()
-
-    # index of unique (iso3, iso3_suffix, year)
-    idx: pd.DataFrame = (
-        life[["ISO3", "ISO3_suffix", "Year"]]
-        .drop_duplicates()
-    )
-
-    # merge income (iso3, year) only
-    out = idx.merge(
-        inc[["ISO3", "Year", "IS"]],
-        on=["ISO3", "Year"],
-        how="left"
-    ).sort_values(["ISO3", "ISO3_suffix", "Year"])
-
-    out["ISO3_suffix"] = out["ISO3_suffix"].fillna("")
+    # make sure ISO3 all upper case (the registry's ISO3 already is)
+    inc = income_status_df[["ISO3", "Year", "IS"]].assign(ISO3=income_status_df["ISO3"].astype(str).str.upper().str.strip())
+
+    # unique (iso3, iso3_suffix, year) from the registry, income matched on (iso3, year) only
+    out = populations.keys().set_axis(pd.Index(range(len(populations)), name="cy_id"))
+    out = out.join(inc.set_index(["ISO3", "Year"])["IS"], on=["ISO3", "Year"])
     
     log.log("formated the country table")
-    return out[["ISO3", "ISO3_suffix", "Year", "IS"]]
-
+    return out
 
-def generate_country_table(life_table_path, download: bool):
-    income_status_df, path = income_status.generate_income_status_df(download)
 
-    life_table_df = load_life_table(life_table_path)
-    country_table_df = format_country_table(income_status_df, life_table_df)
+def generate_country_table(life_table_path, download: bool = False):
+    with instrument.stage("income_status") as s:
+        income_status_df, path = income_status.generate_income_status_df(download)
+        s.rows_out = len(income_status_df)
 
-    log.log("calcualting all keyfitz entropy using matricies (H_N) fr all country-years")
-    H_df = calculate_H_for_dataset(life_table_df)
+    with instrument.stage("country_table"):
+        return write_country_table(life_table_path, income_status_df)
 
 
-
-    #merge H_N values into country table
-    country_table_df = country_table_df.merge(
-        H_df[['ISO3', 'ISO3_suffix', 'Year', 'H_N']],
-        on=["ISO3", "ISO3_suffix", "Year"],
-        how="left"
-    )
-
-    
-    
+def write_country_table(life_table_path, income_status_df: pd.DataFrame, name: str = "country_table") -> str:
+    '''
+    country table of this run (income status and metrics per country-year) written as name, returns its path
+    '''
+    # reuse the country table while the life table, income status, metric settings and metric code are unchanged
+    key = stage_cache.stage_key(
+        "country_table", stage_cache.hash_path(life_table_path), stage_cache.hash_frame(income_status_df),
+        settings=("metrics_engine", "min_age", "max_age"),
+        sources=(__file__, metrics.__file__, panel.__file__, panel_store.__file__, population.__file__, Keyfitz_entropy.__file__, life_table_derivatives.__file__, schema.__file__))
+    country_table_df = stage_cache.cached("country_table", key, lambda: build_country_table(life_table_path, income_status_df))
+
+    path = write_table(country_table_df, name)
+    instrument.count(rows_out=len(country_table_df))
+    return path
 
 
+def merge_metric_tables(country_table_path, metric_table_paths) -> str:
+    '''
+    add the metric columns the R scripts wrote to their own tables (country table + new columns) to the country table,
+    written as the country table of this run
+    '''
+    keys = ["ISO3", "ISO3_suffix", "Year"]
+    country_table_df = read_table(country_table_path)
+    for path in metric_table_paths:
+        metric_df = read_table(path)
+        columns = [c for c in metric_df.columns if c not in country_table_df.columns]
+        country_table_df = country_table_df.merge(metric_df[keys + columns], on=keys, how="left")
+        log.log(f"merged {', '.join(columns)} into country table")
+
+    path = write_table(country_table_df, "country_table")
+    instrument.count(rows_out=len(country_table_df))
+    return path
 
-    log.log("merged H_N values into country table")
 
-    path = os.path.join(OUT_PATH, "country_table.csv")
-    country_table_df.to_csv(path, index=False)
-    return path
+def build_country_table(life_table_path, income_status_df: pd.DataFrame) -> pd.DataFrame:
+    # the binary panel written next to the life table is memory-mapped, the text table is only parsed without one
+    store = open_panel_store(life_table_path)
+    if store is not None:
+        log.log(f"reading the life table panel: {store.folder}")
+        populations = store.registry()
+        life_panel = store.panel(PANEL_COLUMNS)
+    else:
+        life_table_df = load_life_table(life_table_path)
+        populations, (cy_id,) = index_populations(life_table_df)
+        life_panel = build_panel(life_table_df, columns=PANEL_COLUMNS, populations=populations, cy_id=cy_id)
+    country_table_df = format_country_table(income_status_df, populations)
+
+    if metrics_engine() == "python":
+        # all metrics in one pass over the life table, the country table is written once
+        log.log("calculating all metrics (H_N, T, Ne, mx shape, PrR) for all country-years")
+        columns = METRIC_COLUMNS
+    else:
+        # the R scripts add the other metrics to the written country table
+        log.log("calcualting all keyfitz entropy using matricies (H_N) fr all country-years")
+        columns = ["H_N"]
+
+    # the last metrics are kept under a key of the metric code and settings only, so after a data update
+    # just the country-years whose lx/mx fingerprint changed are recomputed
+    key = stage_cache.stage_key(
+        "metrics", *columns, settings=("metrics_engine", "min_age", "max_age"),
+        sources=(metrics.__file__, panel.__file__, population.__file__, Keyfitz_entropy.__file__, life_table_derivatives.__file__))
+    with instrument.stage("metrics", rows_in=int(life_panel.present.sum())) as s:
+        metrics_df = calculate_panel_metrics(life_panel, stage_cache.load("metrics", key), columns)
+        stage_cache.store("metrics", key, metrics_df)
+        s.rows_out = len(metrics_df)
+
+    #merge metric values into country table, both are indexed by cy_id
+    metric_columns = [c for c in metrics_df.columns if c not in ("ISO3", "ISO3_suffix", "Year")]
+    country_table_df = country_table_df.join(metrics_df[metric_columns]).reset_index(drop=True)
+
+    log.log(f"merged {', '.join(metric_columns)} into country table")
+    return apply_schema(country_table_df, COUNTRY_TABLE_SCHEMA, "country table")
@@ -0,0 +1,191 @@
+import os, json, hashlib, zipfile, threading, time
+import requests
+from bs4 import BeautifulSoup
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from src.python.helper import DOWNLOAD_FOLDER, get_credentials
+from src.python import log
+
+
+CHUNK_SIZE = 1 << 20 # 1 MiB
+
+# per source url: local path, ETag, Last-Modified, size and sha256 of the last complete download
+CACHE_FILE = os.path.join(DOWNLOAD_FOLDER, "download_cache.json")
+cache_lock = threading.Lock() # sources are downloaded concurrently and share the cache file
+
+# shared retry/backoff policy for every source (1s, 2s, 4s between attempts)
+RETRY = Retry(total=3, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504])
+
+
+def load_cache() -> dict:
+    if not os.path.exists(CACHE_FILE): return {}
+    with open(CACHE_FILE, "r") as f:
+        return json.load(f)
+
+
+def save_entry(url: str, entry: dict):
+    # read-modify-write under the lock so concurrent downloads don't drop each other's entries
+    with cache_lock:
+        cache = load_cache()
+        cache[url] = entry
+        os.makedirs(os.path.dirname(CACHE_FILE), exist_ok=True)
+        tmp = CACHE_FILE + f".{threading.get_ident()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(cache, f, indent=2)
+        os.replace(tmp, CACHE_FILE)
+
+
+def file_sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def validators(r: requests.Response) -> dict:
+    return {"etag": r.headers.get("ETag"), "last_modified": r.headers.get("Last-Modified")}
+
+
+# pooled session with the shared retry policy
+def make_session() -> requests.Session:
+    s = requests.Session()
+    adapter = HTTPAdapter(max_retries=RETRY, pool_connections=4, pool_maxsize=4)
+    s.mount("https://", adapter)
+    s.mount("http://", adapter)
+    return s
+
+
+# log in to an HMD/HFD style site (anti-forgery token + credentials), cookies persist on the session
+def login(session: requests.Session, login_url: str, name: str):
+    # get anti-forgery token
+    try:
+        r = session.get(login_url, timeout=60)
+        r.raise_for_status()
+    except requests.RequestException as e:
+        log.error(f"could not open the {name} login page {login_url}: {e}")
+    soup = BeautifulSoup(r.text, "html.parser")
+    field = soup.find("input", {"name": "__RequestVerificationToken"})
+    token = field.get("value") if field else None
+    if not token:
+        log.error(f"could not fetch anti-forgery token for the {name}")
+    log.log(f"fetched anti-forgery token for the {name}")
+
+    # post login credentials and token
+    EMAIL, PASSWORD = get_credentials()
+    payload = {
+    "Email": EMAIL,
+    "Password": PASSWORD,
+    "__RequestVerificationToken": token
+    }
+
+    try:
+        r = session.post(login_url, data=payload, timeout=60)
+        r.raise_for_status()
+    except requests.RequestException as e:
+        log.error(f"could not log in to the {name} at {login_url}: {e}")
+    if "Logout" not in r.text and "Log out" not in r.text:
+        log.error(f"failed to login to the {name}")
+    log.log(f"successfully logged in to the {name}")
+
+
+# download url to path, streaming in chunks, returns the number of bytes transferred
+#   - unchanged content (304 or same sha256) leaves the local file untouched
+#   - an interrupted transfer (path.part) is resumed with a Range request
+#   - http errors, timeouts and lost connections are logged as errors naming the url
+def fetch(session: requests.Session, url: str, path: str, timeout=60) -> int:
+    try:
+        return fetch_url(session, url, path, timeout)
+    except requests.RequestException as e:
+        resume = " (partial download kept, resumed next time)" if os.path.exists(path + ".part") else ""
+        log.error(f"download failed from {url}: {e}{resume}")
+
+
+def fetch_url(session: requests.Session, url: str, path: str, timeout) -> int:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    part = path + ".part"
+    with cache_lock:
+        entry = load_cache().get(url, {})
+
+    headers = {}
+    partial = entry.get("partial") or {}
+    resume_from = os.path.getsize(part) if os.path.exists(part) else 0
+    if resume_from and (partial.get("etag") or partial.get("last_modified")):
+        # resume only if the server still has the same content, otherwise it sends all of it (200)
+        headers["Range"] = f"bytes={resume_from}-"
+        headers["If-Range"] = partial.get("etag") or partial.get("last_modified")
+    elif os.path.exists(path) and entry.get("size") == os.path.getsize(path):
+        if entry.get("etag"): headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"): headers["If-Modified-Since"] = entry["last_modified"]
+
+    size = 0
+    with session.get(url, headers=headers, stream=True, timeout=timeout) as r:
+        if r.status_code == 304:
+            log.log(f"not modified since last download, skipping: {url}")
+            return 0
+        if r.status_code == 416: # stale partial download
+            os.remove(part)
+            save_entry(url, {k: v for k, v in entry.items() if k != "partial"})
+            return fetch_url(session, url, path, timeout)
+        r.raise_for_status()
+
+        resumed = r.status_code == 206
+        if resumed: log.log(f"resuming download at byte {resume_from}: {url}")
+
+        # remember validators of this transfer so an interruption can be resumed
+        entry["partial"] = validators(r)
+        save_entry(url, entry)
+
+        with open(part, "ab" if resumed else "wb") as f:
+            for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                f.write(chunk)
+                size += len(chunk)
+
+    if os.path.getsize(part) == 0:
+        os.remove(part)
+        log.error(f"downloaded no content from: {url}")
+
+    digest = file_sha256(part)
+    if digest == entry.get("sha256") and os.path.exists(path):
+        # same content as the previous download, keep the existing file
+        os.remove(part)
+        log.log(f"content unchanged (sha256 match), keeping: {path}")
+    else:
+        # only replace a previous file once the new one is complete
+        os.replace(part, path)
+
+    entry.update(entry.pop("partial"))
+    entry.update({"path": path, "size": os.path.getsize(path), "sha256": digest})
+    save_entry(url, entry)
+    return size
+
+
+# find the single archive member accepted by match(name), without extracting anything
+def find_member(archive: zipfile.ZipFile, match) -> str:
+    members = [m.filename for m in archive.infolist() if not m.is_dir() and match(m.filename)]
+    if len(members) != 1:
+        log.error(f"archive members are indistinguishable or not found: {members}", archive.filename)
+    return members[0]
+
+
+# run independent downloads concurrently, each source is a function returning the bytes it transferred
+def download_all(sources: dict):
+    def timed(name, fn):
+        start = time.perf_counter()
+        try:
+            size = fn()
+        except requests.RequestException as e: # requests outside fetch/login
+            log.error(f"{name} download failed: {e}")
+        return name, size, time.perf_counter() - start
+
+    log.log(f"downloading {len(sources)} sources concurrently: {', '.join(sources)}")
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=len(sources)) as pool:
+        futures = [pool.submit(timed, name, fn) for name, fn in sources.items()]
+        results = [f.result() for f in futures]
+
+    for name, size, elapsed in results:
+        log.log(f"  {name}: {size} bytes in {elapsed:.2f}s")
+    log.log(f"download phase done in {time.perf_counter() - start:.2f}s")
+    return results
@@ -1,10 +1,6 @@
-import os, json5
+import os, re, json5, threading
 from datetime import datetime
-from dotenv import load_dotenv
-
-load_dotenv()
-EMAIL = os.environ.get("EMAIL")
-PASSWORD = os.environ.get("PASSWORD")
+from functools import lru_cache
 
 SETTINGS_FILE = "settings.json5"
 
@@ -19,18 +15,51 @@ def get_datetimestamp(): return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 def get_timestamp(): return datetime.now().strftime("%H:%M:%S")
 
 
-# initiate settings as global variable
-with open(SETTINGS_FILE, "r") as f:
-    SETTINGS = json5.load(f)
+# run context: settings, credentials and the output folder are only read/created on first use,
+# so importing the package has no side effects (e.g. for library or notebook use)
+
+@lru_cache(maxsize=None)
+def get_settings() -> dict:
+    with open(SETTINGS_FILE, "r") as f:
+        return json5.load(f)
+
+
+@lru_cache(maxsize=None)
+def get_credentials() -> tuple:
+    ''' (EMAIL, PASSWORD) for the HMD/HFD, from the environment or .env '''
+    from dotenv import load_dotenv
+    load_dotenv()
+    return os.environ.get("EMAIL"), os.environ.get("PASSWORD")
+
+
+def run_folders(root: str = OUTPUT_FOLDER) -> list:
+    ''' the data<N> run folders under root as (N, path), newest first '''
+    with os.scandir(root) as entries:
+        return sorted(((int(m.group(1)), e.path) for e in entries if e.is_dir() and (m := re.fullmatch(r"data(\d+)", e.name))),
+                      reverse=True)
+
+
+# find next available output data folder: data<N + 1> for the highest existing data<N>
+def next_output_folder(root: str = OUTPUT_FOLDER) -> str:
+    os.makedirs(root, exist_ok=True)
+    i = max((n for n, _ in run_folders(root)), default=0) + 1
+    while True:
+        candidate = os.path.join(root, f"data{i}")
+        try:
+            os.makedirs(candidate)
+            return candidate
+        except FileExistsError: # taken by a concurrent run
+            i += 1
+
+
+out_path_lock = threading.Lock() # stages running in threads may ask for it at the same time
+
+
+def get_out_path() -> str:
+    ''' output folder of this run, created the first time it is asked for '''
+    with out_path_lock:
+        return run_out_path()
 
 
-# find next avaible output data folder
-i = 1
-while True:
-    candidate = os.path.join(OUTPUT_FOLDER, f"data{i}")
-    if os.path.isdir(candidate):
-        i += 1
-    else:
-        os.makedirs(candidate, exist_ok=True)
-        OUT_PATH =  candidate
-        break
\ No newline at end of file
+@lru_cache(maxsize=None)
+def run_out_path() -> str: return next_output_folder()
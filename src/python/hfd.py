@@ -1,55 +1,27 @@
-import os, requests, zipfile, io
+import os, zipfile, posixpath
 import pandas as pd
-from bs4 import BeautifulSoup
-from src.python.helper import OUT_PATH, DOWNLOAD_FOLDER, EMAIL, PASSWORD, SETTINGS
-from src.python import log
+from src.python.helper import DOWNLOAD_FOLDER, get_settings
+from src.python import log, download, stage_cache, hxd
+from src.python.table_io import write_table
+from src.python.hxd import read_hxd, split_population_code, HFD_DTYPES
 
 
 login_url = "https://www.humanfertility.org/Account/Login"
 download_url = "https://www.humanfertility.org/File/Download/Files/zip/asfr.zip"
 download_path = os.path.join(DOWNLOAD_FOLDER, "HFD")
+archive_path = os.path.join(download_path, "asfr.zip")
 
 
 def download_hfd():
     # run session to persist with cookies
-    with requests.Session() as s:
-        # get anti-forgery token
-        r = s.get(login_url, timeout=60)
-        r.raise_for_status()
-        soup = BeautifulSoup(r.text, "html.parser")
-        token = soup.find("input", {"name": "__RequestVerificationToken"}).get("value")
-        if not token:
-            log.error("could not fetch anti-forgery token for the HFD")
-            raise RuntimeError()
-        log.log("fetched anti-forgery token for the HFD")
-
-        # post login credentials and token
-        payload = {
-        "Email": EMAIL,
-        "Password": PASSWORD,
-        "__RequestVerificationToken": token
-        }
-
-        r = s.post(login_url, data=payload, timeout=60)
-        r.raise_for_status()
-        if "Logout" not in r.text and "Log out" not in r.text:
-            log.error("failed to login to the HFD")
-            raise RuntimeError()
-        log.log("successfully logged in to the HFD")
-
-        # download content
-        log.log("downloading .zip for HFD...")
-        r = s.get(download_url, timeout=60)
-        r.raise_for_status()
-        if not r.content:
-            log.error("could not download .zip content from the HFD")
-            raise RuntimeError()
-        log.log("successfully downloaded .zip from the HFD")
+    with download.make_session() as s:
+        download.login(s, login_url, "HFD")
 
-        # extract .zip file to output directory
-        with zipfile.ZipFile(io.BytesIO(r.content)) as file:
-            file.extractall(download_path)
-        log.log("HFD .zip successfully extracted to: " + download_path)
+        # stream .zip to disk (skipped if unchanged since the last download), members are read straight from the archive by load_hfd
+        log.log("downloading .zip for HFD...")
+        size = download.fetch(s, download_url, archive_path)
+        log.log(f"successfully downloaded .zip from the HFD ({size} bytes transferred): " + archive_path)
+        return size
 
 
 # get specified path for hfd and load into dataframe
@@ -57,16 +29,22 @@ def load_hfd(path) -> pd.DataFrame:
     # TODO implement method to choose asfr - e.g. RR (registered births, resident mothers), TR (total births, resident mothers)
     asfr_type = "RR"
 
-    # get file
+    # read the single RR.txt table straight out of the downloaded .zip
+    archive = os.path.join(path, os.path.basename(archive_path))
+    if os.path.exists(archive):
+        with zipfile.ZipFile(archive) as z:
+            member = download.find_member(z, lambda m: posixpath.basename(m).endswith(f"{asfr_type}.txt"))
+            with z.open(member) as f:
+                df = read_hxd(f, HFD_DTYPES)
+        log.log(f"loaded the HFD into memory from {archive}: {member}")
+        return df
+
+    # fall back to a previously extracted download
     dirs = [f for f in os.listdir(path) if f.endswith(f"RR.txt")]
     if len(dirs) != 1: log.error(f"HFD files are indistinguishable or not found", path)
     path = os.path.join(path, dirs[0])
 
-    df = pd.read_csv(
-        path, 
-        sep=r"\s+", # split if more than 1 space between columns 
-        engine="python",
-        skiprows=2)
+    df = read_hxd(path, HFD_DTYPES)
 
     log.log("loaded the HFD into memory")
     return df
@@ -74,16 +52,13 @@ def load_hfd(path) -> pd.DataFrame:
 
 def format_hfd(df: pd.DataFrame) -> pd.DataFrame:
     df.rename(columns={"Code": "ISO3", "ASFR": "mx"}, inplace=True)
-    df["ISO3_suffix"] = df["ISO3"].str.slice(3).replace("",pd.NA)
-    df["ISO3"] = df["ISO3"].str.slice(0,3)
-    df["Age"] = pd.to_numeric(df["Age"].str.extract(r"(\d+)")[0], errors="coerce") # force age to be numeric, get rid of signs (e.g. +)
+    df["ISO3"], df["ISO3_suffix"] = split_population_code(df["ISO3"]) # age is already numeric (e.g. 12- -> 12) from read_hxd
 
     # drop first and last row of every group because 12- and 55+
-    if SETTINGS["include_edge_data"] == False:
-        df = (
-            df.groupby(["ISO3", "ISO3_suffix" "Year"], group_keys=False)
-            .apply(lambda g: g.iloc[1:-1])
-        )
+    if get_settings()["include_edge_data"] == False:
+        groups = df.groupby(["ISO3", "ISO3_suffix", "Year"], sort=False, dropna=False, observed=True)
+        from_start, from_end = groups.cumcount(), groups.cumcount(ascending=False)
+        df = df[(from_start.to_numpy() > 0) & (from_end.to_numpy() > 0)]
 
     log.log("formatted the HFD")
     return df
@@ -92,11 +67,12 @@ def format_hfd(df: pd.DataFrame) -> pd.DataFrame:
 def generate_hfd_df(download: bool):
     if download: download_hfd()
 
-    raw_hfd_df = load_hfd(download_path)
-    hfd_df = format_hfd(raw_hfd_df)
+    # reuse the formatted table while the download, include_edge_data and this code are unchanged
+    key = stage_cache.stage_key("hfd", stage_cache.hash_path(download_path),
+                                settings=("include_edge_data",), sources=(__file__, hxd.__file__))
+    hfd_df = stage_cache.cached("hfd", key, lambda: format_hfd(load_hfd(download_path)))
 
-    path = os.path.join(OUT_PATH, "hfd.csv")
-    hfd_df.to_csv(path, index=False)
+    path = write_table(hfd_df, "hfd")
 
     log.log("successfully generated the HFD: " + path)
     return hfd_df
\ No newline at end of file
@@ -1,7 +1,8 @@
 import os
 import pandas as pd
-from src.python.helper import OUT_PATH, DOWNLOAD_FOLDER, SETTINGS
-from src.python import log
+from src.python.helper import DOWNLOAD_FOLDER, get_settings
+from src.python import log, stage_cache
+from src.python.table_io import write_table
 
 
 # Path to hunter-gatherer data directory
@@ -101,12 +102,12 @@ def format_hg_data(df: pd.DataFrame, population_code: str, population_name: str)
     
     # Filter age range based on settings
     formatted = formatted[
-        (formatted['Age'] >= SETTINGS['min_age']) & 
-        (formatted['Age'] <= SETTINGS['max_age'])
+        (formatted['Age'] >= get_settings()['min_age']) & 
+        (formatted['Age'] <= get_settings()['max_age'])
     ]
     
     # Reorder columns to match life_table structure
-    # ONLY include Age, lx, mx - R will calculate the rest
+    # ONLY include Age, lx, mx - the derivatives and metrics are calculated later
     columns_order = ['ISO3', 'ISO3_suffix', 'Year', 'Age', 'lx', 'mx']
     formatted = formatted[columns_order]
     
@@ -130,7 +131,27 @@ def generate_hg_df() -> pd.DataFrame:
         'Hadza - Blurton Jones data.csv': ('HDZ', 'Hadza'),
         '!Kung - data.csv': ('KUN', '!Kung')
     }
+
+    # reuse the combined table while the HG files, the age range and this code are unchanged
+    key = stage_cache.stage_key("hg", stage_cache.hash_path(HG_DATA_DIR),
+                                settings=("min_age", "max_age"), sources=(__file__,))
+    hg_df = stage_cache.cached("hg", key, lambda: load_hg_populations(hg_populations))
+    
+    # Save to output
+    path = write_table(hg_df, "hg")
     
+    log.log(f"successfully generated HG dataset: {path}")
+    log.log(f"  Total populations added: {len(hg_populations)}")
+    log.log(f"  Total rows: {len(hg_df)}")
+    
+    return hg_df
+
+
+def load_hg_populations(hg_populations: dict) -> pd.DataFrame:
+    """
+    Load and format every HG population file found in the HG data directory.
+    Returns all populations combined into a single DataFrame.
+    """
     all_hg_data = []
     
     for filename, (code, name) in hg_populations.items():
@@ -162,14 +183,4 @@ def generate_hg_df() -> pd.DataFrame:
         return pd.DataFrame()
     
     # Combine all HG populations
-    hg_df = pd.concat(all_hg_data, ignore_index=True)
-    
-    # Save to output
-    path = os.path.join(OUT_PATH, "hg.csv")
-    hg_df.to_csv(path, index=False)
-    
-    log.log(f"successfully generated HG dataset: {path}")
-    log.log(f"  Total populations added: {len(hg_populations)}")
-    log.log(f"  Total rows: {len(hg_df)}")
-    
-    return hg_df
\ No newline at end of file
+    return pd.concat(all_hg_data, ignore_index=True)
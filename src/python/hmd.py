@@ -1,61 +1,45 @@
-import os, requests, zipfile, io
+import os, zipfile, posixpath
 import pandas as pd
-from bs4 import BeautifulSoup
-from src.python.helper import SETTINGS, OUT_PATH, EMAIL, PASSWORD, DOWNLOAD_FOLDER
-from src.python import log
+from src.python.helper import DOWNLOAD_FOLDER, get_settings
+from src.python import log, download, stage_cache, hxd
+from src.python.table_io import write_table
+from src.python.hxd import read_hxd, split_population_code, HMD_DTYPES
 
 
 login_url = "https://www.mortality.org/Account/Login"
 download_url = "https://www.mortality.org/File/GetDocument/hmd.v6/zip/by_statistic/lt_female.zip"
 download_path = os.path.join(DOWNLOAD_FOLDER, "HMD")
+archive_path = os.path.join(download_path, "lt_female.zip")
 
 
 # downloads the hmd
 def download_hmd():
     # run session to persist with cookies
-    with requests.Session() as s:
-        # get anti-forgery token
-        r = s.get(login_url, timeout=60)
-        r.raise_for_status()
-        soup = BeautifulSoup(r.text, "html.parser")
-        token = soup.find("input", {"name": "__RequestVerificationToken"}).get("value")
-        if not token:
-            log.error("could not fetch anti-forgery token for the HMD")
-            raise RuntimeError()
-        log.log("fetched anti-forgery token for the HMD")
-
-        # post login credentials and token
-        payload = {
-        "Email": EMAIL,
-        "Password": PASSWORD,
-        "__RequestVerificationToken": token
-        }
-
-        r = s.post(login_url, data=payload, timeout=60)
-        r.raise_for_status()
-        if "Logout" not in r.text and "Log out" not in r.text:
-            log.error("failed to login to the HMD")
-            raise RuntimeError()
-        log.log("successfully logged in to the HMD")
-
-        # download content
-        log.log("downloading .zip for HMD...")
-        r = s.get(download_url, timeout=60)
-        r.raise_for_status()
-        if not r.content:
-            log.error("could not download .zip content from the HMD")
-            raise RuntimeError()
-        log.log("successfully downloaded .zip from the HMD")
+    with download.make_session() as s:
+        download.login(s, login_url, "HMD")
 
-        # extract .zip file to output directory
-        with zipfile.ZipFile(io.BytesIO(r.content)) as file:
-            file.extractall(download_path)
-        log.log("HMD .zip successfully extracted to: " + download_path)
+        # stream .zip to disk (skipped if unchanged since the last download), members are read straight from the archive by load_hmd
+        log.log("downloading .zip for HMD...")
+        size = download.fetch(s, download_url, archive_path)
+        log.log(f"successfully downloaded .zip from the HMD ({size} bytes transferred): " + archive_path)
+        return size
 
 
 # get specified path for hmd and load into dataframe
 def load_hmd(path) -> pd.DataFrame:
     value = "1x1"
+
+    # read the single *_1x1 table straight out of the downloaded .zip
+    archive = os.path.join(path, os.path.basename(archive_path))
+    if os.path.exists(archive):
+        with zipfile.ZipFile(archive) as z:
+            member = download.find_member(z, lambda m: posixpath.basename(posixpath.dirname(m)).endswith(f"_{value}"))
+            with z.open(member) as f:
+                df = read_hxd(f, HMD_DTYPES)
+        log.log(f"loaded the HMD into memory from {archive}: {member}")
+        return df
+
+    # fall back to a previously extracted download
     dirs = [f for f in os.listdir(path) if f.endswith(f"_{value}")]
     if len(dirs) != 1: log.error("HMD age class directories are indistinguishable or not found", path)
     path = os.path.join(path, dirs[0])
@@ -65,11 +49,7 @@ def load_hmd(path) -> pd.DataFrame:
     if len(dirs) != 1: log.error(".txt is indistinguishable or cannot be found", path)
     path = os.path.join(path, dirs[0])
 
-    df = pd.read_csv(
-        path, 
-        sep=r"\s+", # split if more than 1 space between columns 
-        engine="python",
-        skiprows=2)
+    df = read_hxd(path, HMD_DTYPES)
 
     log.log("loaded the HMD into memory")
     return df
@@ -80,32 +60,25 @@ def format_hmd(df: pd.DataFrame) -> pd.DataFrame:
 
     hmd_variables = ["PopName", "Year", "Age", "lx", "ex"] # alter accordingly to variables found in HMD life tables
     df = df[hmd_variables].copy() # filter for selected columns
-    df["ISO3_suffix"] = df["PopName"].str.slice(3).replace("",pd.NA)
-    df["PopName"] = df["PopName"].str.slice(0,3)
-    df.rename(columns={"PopName": "ISO3"}, inplace=True) 
-    df["Age"] = pd.to_numeric(df["Age"].str.extract(r"(\d+)")[0], errors="coerce") # force age to be numeric, get rid of signs (e.g. +)
+    df["PopName"], df["ISO3_suffix"] = split_population_code(df["PopName"])
+    df.rename(columns={"PopName": "ISO3"}, inplace=True) # age is already numeric (e.g. 110+ -> 110) from read_hxd
 
     # keep original survivorship as K (radix scale, e.g. per 100,000)
     df.rename(columns={"lx": "K"}, inplace=True)
     df["K"] = pd.to_numeric(df["K"], errors="coerce")
 
-    # base at Age==0 when present
-    base0 = (
-    df.loc[df["Age"] == 0, ["ISO3", "ISO3_suffix", "Year", "K"]].rename(columns={"K": "K0"}))
+    keys = [df["ISO3"], df["ISO3_suffix"], df["Year"]]
 
-    # merge K0
-    df = df.merge(base0, on=["ISO3", "ISO3_suffix", "Year"], how="left")
+    # base at Age==0 when present, broadcast to every row of the country-year
+    K0 = df["K"].where(df["Age"] == 0).groupby(keys, sort=False, dropna=False, observed=True).transform("first")
 
     # normalise lx with l0 = 1
-    df["lx"] = df["K"] / df["K0"]
-    df.drop(columns="K0", inplace=True)
+    df["lx"] = df["K"] / K0
 
     # drop last row of every group because values are 110+, not 110
-    if SETTINGS["include_edge_data"] == False:
-        df = (
-            df.groupby(["ISO3", "Year"], group_keys=False)
-            .apply(lambda g: g.iloc[:-1])
-        )
+    if get_settings()["include_edge_data"] == False:
+        from_end = df.groupby(keys, sort=False, dropna=False, observed=True).cumcount(ascending=False)
+        df = df[from_end.to_numpy() > 0]
 
     log.log("formatted the HMD")
     return df
@@ -114,11 +87,12 @@ def format_hmd(df: pd.DataFrame) -> pd.DataFrame:
 def generate_hmd_df(download: bool) -> pd.DataFrame:
     if download: download_hmd()
 
-    raw_hmd_df = load_hmd(download_path)
-    hmd_df = format_hmd(raw_hmd_df)
+    # reuse the formatted table while the download, include_edge_data and this code are unchanged
+    key = stage_cache.stage_key("hmd", stage_cache.hash_path(download_path),
+                                settings=("include_edge_data",), sources=(__file__, hxd.__file__))
+    hmd_df = stage_cache.cached("hmd", key, lambda: format_hmd(load_hmd(download_path)))
 
-    path = os.path.join(OUT_PATH, "hmd.csv")
-    hmd_df.to_csv(path, index=False)
+    path = write_table(hmd_df, "hmd")
 
     log.log("successfully generated the HMD: " + path)
     return hmd_df
\ No newline at end of file
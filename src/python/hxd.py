@@ -0,0 +1,77 @@
+import numpy as np
+import pandas as pd
+from src.python import log
+
+
+# reader for the whitespace separated text files shared by the HMD and HFD (the "HxD" family)
+# layout: a title line, a blank line, then a header row and whitespace separated columns
+
+HMD_DTYPES = {
+    "PopName": "category",
+    "Year": "int16",
+    "Age": "category", # labels like 0, 1, ..., 110+ are parsed to int16 below
+    "mx": "float64",
+    "qx": "float64",
+    "ax": "float32",
+    "lx": "float64",
+    "dx": "float32",
+    "Lx": "float32",
+    "Tx": "float32",
+    "ex": "float32",
+}
+
+HFD_DTYPES = {
+    "Code": "category",
+    "Year": "int16",
+    "Age": "category", # labels like 12-, 13, ..., 55+ are parsed to int16 below
+    "ASFR": "float64",
+}
+
+
+def parse_age(age: pd.Series) -> pd.Series:
+    '''
+    turn categorical age labels (e.g. 110+, 12-, 55+) into int16 ages;
+    only the unique labels are parsed, the rows just index into them.
+    missing and unparseable ages are NaN (the column is float64 then)
+    '''
+    labels = age.cat.categories.astype(str)
+    parsed = pd.to_numeric(labels.str.extract(r"(\d+)")[0], errors="coerce").to_numpy()
+    codes = age.cat.codes.to_numpy()
+    if np.isnan(parsed).any():
+        log.warn(f"unparseable age labels: {list(labels[np.isnan(parsed)])}")
+    if np.isnan(parsed).any() or (codes < 0).any():
+        return pd.Series(np.append(parsed, np.nan)[codes], index=age.index, name=age.name) # code -1 (missing) -> NaN
+    return pd.Series(parsed.astype(np.int16)[codes], index=age.index, name=age.name)
+
+
+def split_population_code(code: pd.Series):
+    '''
+    split HxD population codes (e.g. DEUTE) into categorical ISO3 (DEU) and ISO3_suffix (TE, NA if none);
+    a missing code gives NA for both
+    '''
+    labels = code.cat.categories.astype(str)
+    codes = code.cat.codes.to_numpy()
+    iso3 = pd.Categorical(labels.str.slice(0, 3))
+    suffix = pd.Categorical(labels.str.slice(3).to_series().replace("", pd.NA))
+    # per label codes, with -1 appended so the -1 of a missing code stays -1
+    def per_row(per_label: pd.Categorical) -> pd.Series:
+        return pd.Series(pd.Categorical.from_codes(np.append(per_label.codes, -1)[codes], per_label.categories), index=code.index)
+    return per_row(iso3), per_row(suffix)
+
+
+def read_hxd(source, dtypes: dict) -> pd.DataFrame:
+    '''
+    read an HMD/HFD text file (path or open file) with the C parser and explicit dtypes
+    '''
+    df = pd.read_csv(
+        source,
+        sep=r"\s+", # split if more than 1 space between columns, handled natively by the C engine
+        engine="c",
+        skiprows=2,
+        na_values=["."], # HxD marks missing values with a dot
+        dtype=dtypes)
+
+    if "Age" in df.columns and isinstance(df["Age"].dtype, pd.CategoricalDtype):
+        df["Age"] = parse_age(df["Age"])
+
+    return df
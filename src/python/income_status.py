@@ -1,7 +1,8 @@
-import os, requests
+import os
 import pandas as pd
-from src.python.helper import OUT_PATH, DOWNLOAD_FOLDER, SETTINGS
-from src.python import log
+from src.python.helper import DOWNLOAD_FOLDER
+from src.python import log, download, stage_cache
+from src.python.table_io import write_table
 
 
 download_url = "https://ddh-openapi.worldbank.org/resources/DR0095334/download"
@@ -11,26 +12,16 @@ download_path = os.path.join(DOWNLOAD_FOLDER, "WBLG", "WorldBank_Country_Lending
 def download_income_status():
     # no need to login for world bank
 
-    with requests.Session() as s:
+    with download.make_session() as s:
 
-        # download content
+        # download content (skipped if unchanged since the last download)
         log.log("downloading .xlxs from the WBLG database...")
-        r = s.get(download_url, timeout=60)
-        r.raise_for_status()
-        if not r.content:
-            log.error("could not download .xlsx content from the WBLG")
-            raise RuntimeError()
-
-        # make sure output directory exists
-        path = os.path.dirname(download_path)
-        os.makedirs(path, exist_ok=True)
 
         # IMPORTANT: for world bank, path include file name.xlxs
-        path = download_path
-        with open(path, "wb") as f:
-            f.write(r.content)
+        size = download.fetch(s, download_url, download_path)
     
-        log.log("successfully downloaded .xlxs from the WBLG")
+        log.log(f"successfully downloaded .xlxs from the WBLG ({size} bytes transferred)")
+        return size
 
 
 def load_income_status(path) -> pd.DataFrame:
@@ -68,11 +59,10 @@ def format_income_status(df: pd.DataFrame) -> pd.DataFrame:
 def generate_income_status_df(download: bool):
     if download: download_income_status()
 
-    raw_income_status_df = load_income_status(download_path)
-    income_status_df = format_income_status(raw_income_status_df)
+    key = stage_cache.stage_key("income_status", stage_cache.hash_path(download_path), sources=(__file__,))
+    income_status_df = stage_cache.cached("income_status", key, lambda: format_income_status(load_income_status(download_path)))
 
-    path = os.path.join(OUT_PATH, "income_status.csv")
-    income_status_df.to_csv(path, index=False)
+    path = write_table(income_status_df, "income_status")
 
     log.log("successfully generated the income status of countries: " + path)
     return income_status_df, path
@@ -0,0 +1,192 @@
+import os, io, sys, json, time, pstats, cProfile, threading, tracemalloc
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, asdict
+from src.python.helper import get_out_path, get_datetimestamp
+from src.python import log
+
+try: import resource # not available on Windows, the process peaks are left out there
+except ImportError: resource = None
+
+
+# per stage wall time, CPU time, peak RSS and rows in/out, written to run_metrics.json in the run's output folder
+# after every stage so runs can be compared.
+# cpu_s is the CPU time of the thread running the stage (work it hands to other threads, e.g. pyarrow's pool, is
+# not in it). child processes (Rscript, the metrics workers) can only be measured process wide, so children_cpu_s
+# is only set for a stage that ran alone; stages that ran while a stage in another thread was running (the
+# scheduler overlaps independent stages, src/python/scheduler.py) are marked overlapped.
+# peak_rss_mb is the peak resident memory during the stage: on Linux the high-water mark (VmHWM) is reset when a
+# stage starts and read when it ends (elsewhere it is left out). a reset is first folded into the peaks of the
+# stages already running, so nested and overlapping stages keep theirs (an overlapped stage's peak includes the
+# memory of the stages next to it). process_peak_rss_mb is the peak of the whole process so far.
+# with profiling enabled (main.py --profile) each top-level python stage also gets a cProfile dump and
+# the peak of python allocations traced by tracemalloc
+
+METRICS_FILE = "run_metrics.json"
+CLEAR_REFS = "/proc/self/clear_refs" # writing 5 resets VmHWM (Linux)
+STATUS = "/proc/self/status"
+PROFILE_FOLDER = "profile"
+PROFILE_LINES = 30
+
+STARTED = get_datetimestamp()
+records = []
+records_lock = threading.Lock() # stages run concurrently under the scheduler (src/python/scheduler.py)
+running = [] # (record, thread id) of the stages in progress
+peak_before_reset = 0.0 # process peak RSS (MB) up to the last VmHWM reset, which also resets ru_maxrss
+current_record = ContextVar("record", default=None)
+profiling = False
+active_profile = None
+
+
+@dataclass
+class StageRecord:
+    stage: str
+    rows_in: int = None
+    rows_out: int = None
+    wall_s: float = None
+    cpu_s: float = None # the stage's thread
+    children_cpu_s: float = None # child processes reaped during the stage, None when it overlapped other stages
+    overlapped: bool = False # another thread's stage ran at the same time
+    peak_rss_mb: float = None # during the stage (Linux)
+    process_peak_rss_mb: float = None # of the process since it started, not of the stage
+    process_children_peak_rss_mb: float = None # of the largest child process waited for so far
+    traced_peak_mb: float = None
+
+
+def enable_profiling():
+    global profiling
+    profiling = True
+    tracemalloc.start()
+
+
+def process_peak_rss_mb(who) -> float:
+    ''' high-water mark of resident memory over the process's life (of its largest child with RUSAGE_CHILDREN) '''
+    if resource is None: return None
+    kb = resource.getrusage(who).ru_maxrss
+    mb = kb / 1024 ** 2 if sys.platform == "darwin" else kb / 1024 # bytes on macOS, KiB on Linux
+    return max(mb, peak_before_reset) if who == resource.RUSAGE_SELF else mb
+
+
+def children_cpu_seconds() -> float:
+    t = os.times()
+    return t.children_user + t.children_system
+
+
+def vm_hwm_mb() -> float:
+    ''' peak resident memory since the last reset_peak_rss (VmHWM), None where there is no /proc '''
+    try:
+        with open(STATUS) as f:
+            for line in f:
+                if line.startswith("VmHWM:"): return int(line.split()[1]) / 1024 # kB
+    except OSError:
+        pass
+    return None
+
+
+def reset_peak_rss() -> bool:
+    try:
+        with open(CLEAR_REFS, "w") as f:
+            f.write("5")
+        return True
+    except OSError: # not Linux, or not allowed
+        return False
+
+
+def start_record(record: StageRecord):
+    '''
+    register a running stage, marking it and the stages running in other threads as overlapped,
+    and start its peak RSS (the peak so far goes to the running stages first)
+    '''
+    global peak_before_reset
+    thread = threading.get_ident()
+    with records_lock:
+        others = [r for r, t in running if t != thread]
+        for r in others: r.overlapped = True
+        record.overlapped = record.overlapped or bool(others)
+
+        peak = vm_hwm_mb()
+        for r, _ in running:
+            if r.peak_rss_mb is not None: r.peak_rss_mb = max(r.peak_rss_mb, peak)
+        if peak is not None and reset_peak_rss():
+            peak_before_reset = max(peak_before_reset, peak)
+            record.peak_rss_mb = 0.0 # None: no per stage peak here
+        running.append((record, thread))
+
+
+def end_record(record: StageRecord):
+    with records_lock:
+        running[:] = [(r, t) for r, t in running if r is not record]
+        if record.peak_rss_mb is not None: record.peak_rss_mb = round(max(record.peak_rss_mb, vm_hwm_mb()), 1)
+
+
+def count(rows_in: int = None, rows_out: int = None):
+    ''' set rows in/out on the record of the innermost running stage (for code that does not hold the record) '''
+    record = current_record.get()
+    if record is None: return
+    if rows_in is not None: record.rows_in = rows_in
+    if rows_out is not None: record.rows_out = rows_out
+
+
+def write_metrics():
+    path = os.path.join(get_out_path(), METRICS_FILE)
+    with open(path + ".tmp", "w") as f:
+        json.dump({"started": STARTED, "python": sys.version.split()[0], "profiled": profiling,
+                   "stages": [asdict(r) for r in records]}, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def write_profile(name: str, profile: cProfile.Profile):
+    folder = os.path.join(get_out_path(), PROFILE_FOLDER)
+    os.makedirs(folder, exist_ok=True)
+    profile.dump_stats(os.path.join(folder, f"{name}.prof"))
+
+    text = io.StringIO()
+    pstats.Stats(profile, stream=text).sort_stats("cumulative").print_stats(PROFILE_LINES)
+    with open(os.path.join(folder, f"{name}.txt"), "w") as f:
+        f.write(text.getvalue())
+
+
+@contextmanager
+def stage(name: str, rows_in: int = None):
+    '''
+    time the block as a pipeline stage; set rows_out (and rows_in) on the yielded record
+    '''
+    global active_profile
+    record = StageRecord(name, rows_in=rows_in)
+
+    # stages nest (e.g. hmd inside life_table), only the outermost one is profiled
+    profile = None
+    if profiling and active_profile is None:
+        profile = active_profile = cProfile.Profile()
+        tracemalloc.reset_peak()
+
+    start_record(record)
+    wall, cpu, children_cpu = time.perf_counter(), time.thread_time(), children_cpu_seconds()
+    token = current_record.set(record)
+    with log.stage(name):
+        try:
+            if profile: profile.enable()
+            yield record
+        finally:
+            if profile: profile.disable()
+            current_record.reset(token)
+            record.wall_s = round(time.perf_counter() - wall, 3)
+            record.cpu_s = round(time.thread_time() - cpu, 3)
+            end_record(record) # overlapped is final now
+            if not record.overlapped: record.children_cpu_s = round(children_cpu_seconds() - children_cpu, 3)
+            if resource is not None:
+                record.process_peak_rss_mb = round(process_peak_rss_mb(resource.RUSAGE_SELF), 1)
+                record.process_children_peak_rss_mb = round(process_peak_rss_mb(resource.RUSAGE_CHILDREN), 1)
+            if profile:
+                record.traced_peak_mb = round(tracemalloc.get_traced_memory()[1] / 1e6, 1)
+                write_profile(name, profile)
+                active_profile = None
+
+            with records_lock:
+                records.append(record)
+                write_metrics()
+            log.log(f"stage {name}: {record.wall_s:.2f}s wall, {record.cpu_s:.2f}s cpu"
+                    + (f" + {record.children_cpu_s:.2f}s in child processes" if record.children_cpu_s else "")
+                    + (" (overlapped other stages)" if record.overlapped else "")
+                    + (f", {record.rows_in} rows in" if record.rows_in is not None else "")
+                    + (f", {record.rows_out} rows out" if record.rows_out is not None else ""))
@@ -1,59 +1,120 @@
-import os
+import numpy as np
 import pandas as pd
-from src.python import hmd, hfd, hg, log
-from src.python.helper import SETTINGS, OUT_PATH
-from src.python.helper import SETTINGS, OUT_PATH
+from src.python import hmd, hfd, hg, log, stage_cache, schema, life_table_derivatives, instrument, population
+from src.python.helper import get_settings
+from src.python.table_io import write_table
+from src.python.schema import apply_schema, LIFE_TABLE_SCHEMA
+from src.python.life_table_derivatives import add_life_table_derivatives
+from src.python.panel import build_panel
+from src.python.panel_store import STORE_COLUMNS, panel_folder, write_panel_store
+
+KEYS = ["ISO3", "ISO3_suffix", "Year"]
+
+
+def rows_by_key_age(df: pd.DataFrame, cy_id: np.ndarray, ages: np.ndarray, target: np.ndarray, name: str) -> np.ndarray:
+    '''
+    row of df for every target country-year x age key (cy_id * len(ages) + age position), -1 where df has none
+    '''
+    age = df["Age"].to_numpy(dtype=np.int64)
+    key = cy_id.astype(np.int64) * len(ages) + (age - ages[0])
+    outside = (age < ages[0]) | (age > ages[-1])
+    key[outside] = -1 - np.arange(int(outside.sum())) # never matched, and not duplicates of each other
+
+    index = pd.Index(key)
+    duplicated = index.duplicated()
+    if duplicated.any():
+        log.warn(f"{name}: {int(duplicated.sum())} duplicated country-year-age rows, keeping the first")
+    first = np.flatnonzero(~duplicated)
+    found = pd.Index(key[first]).get_indexer(target)
+    return np.where(found >= 0, first[found], -1)
+
 
 def merge_hmd_hfd_df(hmd_df: pd.DataFrame, hfd_df: pd.DataFrame):
-    # filter only common country, year pairs
-    common_df = pd.merge(
-        hmd_df[["ISO3", "ISO3_suffix","Year"]].drop_duplicates(),
-        hfd_df[["ISO3","ISO3_suffix","Year"]].drop_duplicates(),
-        on=["ISO3","ISO3_suffix", "Year"],
-        how="inner"
-        )
-    
-    #checking for duplicates despite the check 
-    dup_check = common_df.groupby(["ISO3", "ISO3_suffix", "Year"]).size()
-    if (dup_check > 1).any():
-        print("WARNING: Duplicates found in common_df:")
-        print(dup_check[dup_check > 1])
-    
+    # integer country-year ids shared by both tables (ISO3 and suffix compared as strings, "" for a missing suffix)
+    populations, (hmd_cy, hfd_cy) = population.index_populations(hmd_df, hfd_df)
 
-    # find all rows that exist in common
-    hmd_df = hmd_df.merge(common_df, on=["ISO3", "ISO3_suffix", "Year"], how="inner")
-    hfd_df = hfd_df.merge(common_df, on=["ISO3", "ISO3_suffix", "Year"], how="inner")
+    # filter only common country, year pairs (in HMD order)
+    hmd_keys = pd.unique(hmd_cy)
+    common = hmd_keys[np.isin(hmd_keys, hfd_cy)]
 
-    # restrict HMD ages between min_age and max_age, adjust acordingly (max = 110)
-    hmd_df = hmd_df[hmd_df["Age"].between(SETTINGS["min_age"], SETTINGS["max_age"])]
+    # full country-year x age grid, min_age...max_age for each common (country, year)
+    # restricts HMD ages between min_age and max_age, adjust acordingly (max = 110)
+    ages = np.arange(get_settings()["min_age"], get_settings()["max_age"] + 1)
+    target = np.repeat(common.astype(np.int64) * len(ages), len(ages)) + np.tile(np.arange(len(ages)), len(common))
 
-    # building a full age grid min_age...max_age for each common (country, year)
-    ages = pd.DataFrame({"Age": list(range(SETTINGS["min_age"], SETTINGS["max_age"] + 1))})
-    grid = common_df.assign(_k=1).merge(ages.assign(_k=1), on="_k").drop(columns="_k")
-    
-    # merge lx (HMD) and asfr (HFD)
-    log.log(f"hmd_df DEU TE1956 Age 15 count: {len(hmd_df[(hmd_df['ISO3']=='DEU') & (hmd_df['ISO3_suffix']=='TE') & (hmd_df['Year']==1956) & (hmd_df['Age']==15)])}")
-    df = grid.merge(hmd_df, on=["ISO3", "ISO3_suffix", "Year", "Age"], how="left")
-    df = df.merge(hfd_df, on=["ISO3", "ISO3_suffix","Year", "Age"], how="left")
+    if get_settings().get("debug", False):
+        deu = populations.keys(hmd_cy).eval("ISO3 == 'DEU' and ISO3_suffix == 'TE' and Year == 1956").to_numpy()
+        log.log(f"hmd_df DEU TE1956 Age 15 count: {int((deu & (hmd_df['Age'].to_numpy() == 15)).sum())}")
 
+    # rows of lx (HMD) and asfr (HFD) on the grid, put side by side
+    hmd_rows = rows_by_key_age(hmd_df, hmd_cy, ages, target, "HMD")
+    hfd_rows = rows_by_key_age(hfd_df, hfd_cy, ages, target, "HFD")
+    hmd_part = hmd_df.drop(columns=[*KEYS, "Age"]).reset_index(drop=True).reindex(hmd_rows)
+    hfd_part = hfd_df.drop(columns=[*KEYS, "Age"]).reset_index(drop=True).reindex(hfd_rows)
 
-    # reorder
-    front = ["ISO3", "ISO3_suffix", "Year", "Age"]
-    df = df[[*front, *[c for c in df.columns if c not in front]]]
+    keys = populations.keys(np.repeat(common, len(ages)))
+    df = pd.DataFrame({
+        "ISO3": keys["ISO3"].to_numpy(),
+        "ISO3_suffix": keys["ISO3_suffix"].to_numpy(), # "" (not NA) for no suffix, so parquet/feather readers join it like the country table
+        "Year": keys["Year"].to_numpy(),
+        "Age": np.tile(ages, len(common)),
+        **{c: hmd_part[c].to_numpy() for c in hmd_part.columns},
+        **{c: hfd_part[c].to_numpy() for c in hfd_part.columns if c not in hmd_part.columns},
+    })
+    df = apply_schema(df, LIFE_TABLE_SCHEMA, "merged HMD/HFD")
 
     log.log("merged the HMD and HFD tables and separated ISO3 from the suffix")
     return df
 
 
-def generate_life_table(download: bool) -> str:
+def generate_life_table(download: bool = False) -> str:
     # generate formatted data from HMD and HFD
-    hmd_df = hmd.generate_hmd_df(download)
-    hfd_df = hfd.generate_hfd_df(download)
+    with instrument.stage("hmd") as s:
+        hmd_df = hmd.generate_hmd_df(download)
+        s.rows_out = len(hmd_df)
+    with instrument.stage("hfd") as s:
+        hfd_df = hfd.generate_hfd_df(download)
+        s.rows_out = len(hfd_df)
     
     # Generate HG data (no download needed, it's local)
-    hg_df = hg.generate_hg_df()
+    with instrument.stage("hg") as s:
+        hg_df = hg.generate_hg_df()
+        s.rows_out = len(hg_df)
+
+    with instrument.stage("life_table"):
+        return write_life_table(hmd_df, hfd_df, hg_df)
+
+
+def write_life_table(hmd_df: pd.DataFrame, hfd_df: pd.DataFrame, hg_df: pd.DataFrame) -> str:
+    '''
+    merge the formatted HMD, HFD and HG tables into the life table of this run, returns its path
+    '''
+    # reuse the merged table while the formatted inputs, the age range and the merge code are unchanged
+    key = stage_cache.stage_key(
+        "life_table", *map(stage_cache.hash_frame, (hmd_df, hfd_df, hg_df)),
+        settings=("min_age", "max_age"),
+        sources=(__file__, life_table_derivatives.__file__, population.__file__, schema.__file__))
+    combined_df = stage_cache.cached("life_table", key, lambda: build_life_table(hmd_df, hfd_df, hg_df))
+    
+    path = write_table(combined_df, "life_table")
+    if get_settings().get("panel_store", True):
+        write_life_table_panel(combined_df, path)
+    instrument.count(rows_in=len(hmd_df) + len(hfd_df) + len(hg_df), rows_out=len(combined_df))
+    
+    log.log("successfully generated the merged life table: " + path)
+    return path
+
+
+def write_life_table_panel(life_table_df: pd.DataFrame, life_table_path: str) -> str:
+    ''' binary (memory-mapped) panel of the life table next to it, see src/python/panel_store.py '''
+    populations, (cy_id,) = population.index_populations(life_table_df)
+    columns = tuple(c for c in STORE_COLUMNS if c in life_table_df.columns)
+    panel = build_panel(life_table_df, columns=columns, populations=populations, cy_id=cy_id)
+    return write_panel_store(panel, populations, panel_folder(life_table_path))
+
 
-    # merge data from HMD and HFD and export
+def build_life_table(hmd_df: pd.DataFrame, hfd_df: pd.DataFrame, hg_df: pd.DataFrame) -> pd.DataFrame:
+    # merge data from HMD and HFD
     hmd_hfd_df = merge_hmd_hfd_df(hmd_df, hfd_df)
     
     # ADD: Combine with HG data
@@ -63,7 +124,7 @@ def generate_life_table(download: bool) -> str:
         # Get all columns from HMD/HFD merged data
         all_columns = hmd_hfd_df.columns.tolist()
         
-        # Add missing columns to HG data with NaN (will be calculated by R)
+        # Add missing columns to HG data with NaN
         for col in all_columns:
             if col not in hg_df.columns:
                 hg_df[col] = None
@@ -77,9 +138,9 @@ def generate_life_table(download: bool) -> str:
     else:
         combined_df = hmd_hfd_df
         log.log("no HG data to merge, using only HMD/HFD")
-    
-    path = os.path.join(OUT_PATH, "life_table.csv")
-    combined_df.to_csv(path, index=False)
-    
-    log.log("successfully generated the merged life table: " + path)
-    return path
\ No newline at end of file
+
+    # concat falls back to object columns where categories or dtypes differ
+    combined_df = apply_schema(combined_df, LIFE_TABLE_SCHEMA, "life table")
+
+    # compute fields like dx, sx, vx etc... (python port of src/R/life_table_derivatives.R)
+    return add_life_table_derivatives(combined_df)
\ No newline at end of file
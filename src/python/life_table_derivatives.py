@@ -0,0 +1,70 @@
+import numpy as np
+import pandas as pd
+from src.python import log
+from src.python.population import index_populations
+
+
+# python port of src/R/life_table_derivatives.R, vectorized over all country-years at once
+# within a country-year rows are taken in table order (sorted by age), like the R script
+
+# same column order as the R script appends them
+DERIVED_COLUMNS = ["dx", "N", "sx", "lxmx_STAND", "vx", "lxmx_STAND_SUM_qx", "lxmx", "mx_ADJ"]
+
+
+def add_life_table_derivatives(df: pd.DataFrame) -> pd.DataFrame:
+    '''
+    add dx, N, sx, lxmx_STAND, vx, lxmx_STAND_SUM_qx, lxmx and mx_ADJ to the life table
+
+    dx = 1 - lx[x+1] / lx[x]                      (NA at the last age)
+    sx = 1 - dx
+    lxmx = lx * mx, with NA as 0
+    lxmx_STAND = lxmx / sum(lxmx)
+    mx_ADJ = lxmx_STAND / lx
+    lxmx_STAND_SUM_qx = sum(lxmx_STAND[x:])       (reverse cumulative sum)
+    vx = lxmx_STAND_SUM_qx[x+1]^2 / lx[x+1]^2     (NA at the last age)
+    '''
+    lx = pd.to_numeric(df["lx"], errors="coerce").to_numpy(dtype=np.float64)
+    mx = pd.to_numeric(df["mx"], errors="coerce").to_numpy(dtype=np.float64)
+
+    # country-year ids from the population registry instead of grouping on the key columns
+    populations, (group,) = index_populations(df)
+    size = np.bincount(group)[group]
+    from_end = pd.Series(group).groupby(group).cumcount(ascending=False).to_numpy()
+    has_next = from_end > 0
+    used = size >= 2 # groups with a single row are skipped, as in the R script
+
+    # next row of the same country-year
+    lx_next = pd.Series(lx, index=df.index).groupby(group).shift(-1).to_numpy()
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        dx = np.where(has_next, 1 - lx_next / lx, np.nan)
+        sx = 1 - dx
+
+        lxmx = np.nan_to_num(lx * mx, nan=0.0)
+        lxmx_SUM = np.bincount(group, weights=lxmx)[group]
+        lxmx_STAND = lxmx / lxmx_SUM
+        mx_ADJ = lxmx_STAND / lx
+
+        # sum(lxmx_STAND[i:n]) for every i, as a reverse cumulative sum per country-year
+        reverse = pd.Series(lxmx_STAND[::-1]).groupby(group[::-1]).cumsum().to_numpy()
+        lxmx_STAND_SUM_qx = reverse[::-1]
+
+        SUM_qx_next = pd.Series(lxmx_STAND_SUM_qx, index=df.index).groupby(group).shift(-1).to_numpy()
+        vx = np.where(has_next, SUM_qx_next ** 2 / lx_next ** 2, np.nan)
+
+    derived = {
+        "dx": dx,
+        "N": lx * 1000,
+        "sx": sx,
+        "lxmx_STAND": lxmx_STAND,
+        "vx": vx,
+        "lxmx_STAND_SUM_qx": lxmx_STAND_SUM_qx,
+        "lxmx": lxmx,
+        "mx_ADJ": mx_ADJ,
+    }
+    for column in DERIVED_COLUMNS:
+        # N is set for every row, everything else only for country-years with at least 2 rows
+        derived[column] = derived[column] if column == "N" else np.where(used, derived[column], np.nan)
+
+    log.log(f"calculated life table derivatives for {len(populations)} country-years")
+    return df.assign(**derived)
@@ -1,17 +1,104 @@
-import os, sys
-from src.python.helper import get_datetimestamp, OUT_PATH
+import os, sys, json, time, queue, atexit, logging, threading, logging.handlers
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from src.python.helper import get_out_path, get_settings
 
 
+# messages go through a queue to a background listener that writes the console and one buffered log file,
+# so callers (e.g. progress messages in loops) never wait on the disk.
+# the console keeps the "[time] LEVEL: message" format; with log_format: "json" in settings.json5
+# the file gets one json object per line with the stage and elapsed seconds
+
 LOG_FILE = "log_file.log"
-path = os.path.join(OUT_PATH, LOG_FILE)
+JSON_LOG_FILE = "log_file.jsonl"
+BUFFER_RECORDS = 1000 # file writes are batched, warnings and errors are written straight away
+
+START = time.perf_counter()
+current_stage = ContextVar("stage", default=None)
+
+logger = logging.getLogger("population")
+listener = None
+listener_lock = threading.Lock()
+
+
+class PipelineError(Exception):
+    ''' raised by error(), main.py turns it into a non-zero exit '''
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        return f"[{datetime.fromtimestamp(record.created).strftime('%Y-%m-%d %H:%M:%S')}] {record.tag}: {record.getMessage()}"
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        return json.dumps({
+            "time": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.tag,
+            "stage": record.stage,
+            "elapsed": round(record.elapsed, 3),
+            "message": record.getMessage(),
+        })
+
+
+def log_format() -> str: return get_settings().get("log_format", "text")
+
+
+# log file of this run, resolved on the first message
+def log_path() -> str: return os.path.join(get_out_path(), JSON_LOG_FILE if log_format() == "json" else LOG_FILE)
+
+
+def start():
+    ''' set up the queue, the console and file handlers and the listener thread (done on the first message) '''
+    global listener
+    with listener_lock:
+        if listener is None: listener = start_listener()
+
+
+def start_listener() -> logging.handlers.QueueListener:
+    console = logging.StreamHandler(sys.stdout)
+    console.setFormatter(TextFormatter())
+
+    file = logging.FileHandler(log_path(), mode="a", delay=True)
+    file.setFormatter(JsonFormatter() if log_format() == "json" else TextFormatter())
+    buffered = logging.handlers.MemoryHandler(BUFFER_RECORDS, flushLevel=logging.WARNING, target=file)
+
+    q = queue.SimpleQueue()
+    logger.addHandler(logging.handlers.QueueHandler(q))
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+    started = logging.handlers.QueueListener(q, console, buffered)
+    started.start()
+    atexit.register(stop)
+    return started
+
+
+def stop():
+    ''' write out everything still queued or buffered '''
+    global listener
+    if listener is None: return
+    listener.stop()
+    for handler in listener.handlers: handler.close()
+    logger.handlers.clear()
+    listener = None
+
+
+@contextmanager
+def stage(name: str):
+    ''' tag messages logged inside the block with the stage name '''
+    token = current_stage.set(name)
+    try: yield
+    finally: current_stage.reset(token)
 
 
 # write logs to info file and print to terminal
 def write_log(level, message):
-    line = f"[{get_datetimestamp()}] {level}: {message}"
-    with open(path, "a") as f:
-        f.write(line + "\n")
-    print(line)
+    start()
+    logger.log(
+        {"LOG": logging.INFO, "WARNING": logging.WARNING}.get(level, logging.ERROR), message,
+        extra={"tag": level, "stage": current_stage.get(), "elapsed": time.perf_counter() - START})
 
 
 def log(message):  write_log("LOG", message)
@@ -19,4 +106,4 @@ def warn(message): write_log("WARNING", message)
 def error(message, path=None):
     if path is not None: write_log("ERROR", f"{message}\n{path}")
     else: write_log("ERROR", message)
-    sys.exit()
+    raise PipelineError(message)
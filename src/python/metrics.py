@@ -0,0 +1,301 @@
+import os, multiprocessing
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from src.python import log
+from src.python.helper import get_settings
+from src.python.panel import build_panel, LifeTablePanel
+from src.python.Keyfitz_entropy import calculate_H_for_panel
+
+
+# in-process metrics engine: one pass over a shared life table panel computes what
+# generation_time.R, ne_felsenstein.R, mx_shape_metrics.R and prr_calculation.R compute,
+# plus Keyfitz H. every kernel takes the panel and returns per country-year arrays in panel row order.
+
+PANEL_COLUMNS = ("Age", "lx", "mx", "dx", "sx", "vx", "N")
+
+# country table columns, in the order the R scripts used to add them
+METRIC_COLUMNS = [
+    "H_N", "T", "N_sum", "Ne", "N_ratio", "mx_skew", "mx_kurtosis",
+    "B", "M", "Z", "T_B", "T_M", "PrR", "prop_survive_to_B", "prop_survive_to_M",
+]
+
+N1 = 1000 # Ne numerator constant (ne_felsenstein.R)
+
+
+def valid_mask(panel) -> np.ndarray:
+    ''' True for the first lengths[g] cells of every row of a packed array '''
+    return np.arange(len(panel.ages))[None, :] < panel.lengths[:, None]
+
+
+# first position where values >= threshold in each row (np.nan where never reached)
+def first_reaching(values: np.ndarray, threshold: np.ndarray, valid: np.ndarray) -> np.ndarray:
+    hit = valid & (values >= threshold[:, None])
+    idx = np.argmax(hit, axis=1).astype(np.float64)
+    idx[~hit.any(axis=1)] = np.nan
+    return idx
+
+
+def take(values: np.ndarray, idx: np.ndarray) -> np.ndarray:
+    ''' values[g, idx[g]] per row, NaN where idx is NaN '''
+    found = ~np.isnan(idx)
+    out = np.full(len(values), np.nan)
+    out[found] = values[np.flatnonzero(found), idx[found].astype(np.intp)]
+    return out
+
+
+def generation_time(panel) -> dict:
+    '''
+    T = sum(x * lx * mx) / sum(lx * mx), NA values dropped (generation_time.R)
+    '''
+    valid = valid_mask(panel)
+    age, lx, mx = panel.packed("Age"), panel.packed("lx"), panel.packed("mx")
+
+    lxmx = np.where(valid, lx * mx, np.nan)
+    numerator = np.nansum(age * lxmx, axis=1)
+    denominator = np.nansum(lxmx, axis=1)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        T = np.where(denominator != 0, numerator / denominator, np.nan)
+    return {"T": T}
+
+
+def ne_felsenstein(panel, T: np.ndarray) -> dict:
+    '''
+    Ne = N1 * T / (1 + sum(lx[i] * sx[i] * dx[i] * vx[i+1])), finite terms only (ne_felsenstein.R)
+    '''
+    valid = valid_mask(panel)
+    lx, sx, dx, vx, N = (panel.packed(c) for c in ("lx", "sx", "dx", "vx", "N"))
+
+    N_sum = np.nansum(np.where(valid, N, np.nan), axis=1)
+
+    # pairs (i, i+1) inside the country-year
+    pair = valid[:, 1:]
+    term = lx[:, :-1] * sx[:, :-1] * dx[:, :-1] * vx[:, 1:]
+    ok = pair & np.isfinite(lx[:, :-1]) & np.isfinite(sx[:, :-1]) & np.isfinite(dx[:, :-1]) & np.isfinite(vx[:, 1:])
+    denominator = np.where(ok, term, 0).sum(axis=1) + 1
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        Ne = N1 * T / denominator
+        N_ratio = Ne / N_sum
+
+    missing = np.isnan(T)
+    N_sum[missing] = np.nan
+    return {"N_sum": N_sum, "Ne": Ne, "N_ratio": N_ratio}
+
+
+def mx_shape(panel) -> dict:
+    '''
+    skew and kurtosis of mx over the ages with mx present (mx_shape_metrics.R)
+    skew = sum((mx - mean)^3) / ((n - 1) * sd^3), kurtosis likewise with ^4, sd with n - 1
+    '''
+    mx = panel.packed("mx")
+    has = valid_mask(panel) & ~np.isnan(mx)
+    n = has.sum(axis=1)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = np.where(has, mx, 0).sum(axis=1) / n
+        centred = np.where(has, mx - mean[:, None], 0)
+        sd = np.sqrt((centred ** 2).sum(axis=1) / (n - 1))
+        skew = (centred ** 3).sum(axis=1) / ((n - 1) * sd ** 3)
+        kurtosis = (centred ** 4).sum(axis=1) / ((n - 1) * sd ** 4)
+
+    # no mx at all -> the country-year has no row in R, a single value -> sd is NA
+    undefined = n < 2
+    skew[undefined] = np.nan
+    kurtosis[undefined] = np.nan
+    return {"mx_skew": skew, "mx_kurtosis": kurtosis}
+
+
+def prr(panel) -> dict:
+    '''
+    B, M (5% and 95% of cumulative mx), Z (95% of cumulative lx) and
+    PrR = T(M) / T(B) with Tx the person-years lived from age x onward (prr_calculation.R, Levitis Appendix 3)
+    '''
+    valid = valid_mask(panel)
+    age = panel.packed("Age")
+    lx = np.where(valid, np.nan_to_num(panel.packed("lx"), nan=0.0), 0)
+    mx = np.where(valid, np.nan_to_num(panel.packed("mx"), nan=0.0), 0)
+
+    # ages B and M from cumulative mx, Z from cumulative lx
+    total_mx = mx.sum(axis=1)
+    cum_mx = np.cumsum(mx, axis=1)
+    fertile = total_mx > 0
+    B_idx = np.where(fertile, first_reaching(cum_mx, 0.05 * total_mx, valid), np.nan)
+    M_idx = np.where(fertile, first_reaching(cum_mx, 0.95 * total_mx, valid), np.nan)
+
+    total_lx = lx.sum(axis=1)
+    Z_idx = np.where(total_lx > 0, first_reaching(np.cumsum(lx, axis=1), 0.95 * total_lx, valid), np.nan)
+
+    # Lx = lx[x+1] + 0.5 * (lx[x] - lx[x+1]), Tx = sum(Lx[x:])
+    lx_next = np.zeros_like(lx)
+    lx_next[:, :-1] = np.where(valid[:, 1:], lx[:, 1:], 0)
+    Lx = np.where(valid, lx_next + 0.5 * (lx - lx_next), 0)
+    Tx = np.cumsum(Lx[:, ::-1], axis=1)[:, ::-1]
+
+    has_BM = ~np.isnan(B_idx) & ~np.isnan(M_idx) & (panel.lengths > 1)
+    B_Tx = np.where(has_BM, B_idx, np.nan)
+    M_Tx = np.where(has_BM, M_idx, np.nan)
+    T_B, T_M = take(Tx, B_Tx), take(Tx, M_Tx)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        PrR = np.where(T_B > 0, T_M / T_B, np.nan)
+
+    return {
+        "B": take(age, B_idx),
+        "M": take(age, M_idx),
+        "Z": take(age, Z_idx),
+        "T_B": T_B,
+        "T_M": T_M,
+        "PrR": PrR,
+        "prop_survive_to_B": take(lx, B_Tx),
+        "prop_survive_to_M": take(lx, M_Tx),
+    }
+
+
+def metric_arrays(panel, columns=METRIC_COLUMNS) -> dict:
+    ''' the requested metrics as 1-D arrays in panel row order '''
+    results = {"H_N": calculate_H_for_panel(panel)}
+    if any(c != "H_N" for c in columns):
+        T = generation_time(panel)
+        results.update(**T, **ne_felsenstein(panel, T["T"]), **mx_shape(panel), **prr(panel))
+    return {c: results[c] for c in columns}
+
+
+def calculate_metrics_for_panel(panel, columns=METRIC_COLUMNS) -> pd.DataFrame:
+    return panel.to_frame(**metric_arrays(panel, columns))
+
+
+# sharded mode: the panel arrays are copied once into shared memory and worker processes compute
+# blocks of whole populations (ISO3, ISO3_suffix) from it; the blocks come back in panel order
+
+MIN_SHARD_ROWS = 20000 # default of shard_min_rows: smaller panels are computed in process, starting the workers costs ~1s
+SHARDS_PER_WORKER = 4 # several blocks per worker even out populations with many years
+
+
+def workers() -> int:
+    ''' worker processes for the metrics (settings.json5 "workers": 1 = in process, 0 = one per cpu) '''
+    n = int(get_settings().get("workers", 1))
+    return os.cpu_count() or 1 if n <= 0 else n
+
+
+def shard_min_rows() -> int:
+    ''' country-years from which the metrics are sharded over the workers (settings.json5 "shard_min_rows") '''
+    return int(get_settings().get("shard_min_rows", MIN_SHARD_ROWS))
+
+
+def population_shards(panel, n_shards: int) -> list:
+    '''
+    (start, stop) panel row ranges of about equal size that only split between populations;
+    the panel is sorted by key, so the country-years of a population are adjacent
+    '''
+    starts = np.flatnonzero(np.r_[True, panel.pop_id[1:] != panel.pop_id[:-1]])
+
+    targets = np.linspace(0, len(panel), n_shards + 1)[1:-1]
+    cuts = starts[np.minimum(np.searchsorted(starts, targets), len(starts) - 1)]
+    bounds = np.unique(np.r_[0, cuts, len(panel)])
+    return list(zip(bounds[:-1].tolist(), bounds[1:].tolist()))
+
+
+def metrics_shard(values_name: str, present_name: str, shape: tuple, columns: list, ages: np.ndarray,
+                  start: int, stop: int, metric_columns: list) -> dict:
+    ''' worker: metrics of panel rows start..stop, read from the shared arrays '''
+    values_shm = shared_memory.SharedMemory(name=values_name)
+    present_shm = shared_memory.SharedMemory(name=present_name)
+    try:
+        values = np.ndarray(shape, dtype=np.float64, buffer=values_shm.buf)
+        present = np.ndarray(shape[1:], dtype=bool, buffer=present_shm.buf)
+        shard = LifeTablePanel(
+            keys=pd.DataFrame(index=range(stop - start)), ages=ages,
+            offsets=np.zeros(1, dtype=np.int64), order=np.zeros(0, dtype=np.int64),
+            present=present[start:stop], values={c: values[i, start:stop] for i, c in enumerate(columns)})
+        results = {c: np.array(v, copy=True) for c, v in metric_arrays(shard, metric_columns).items()}
+        del values, present, shard # views into the shared buffers must be gone before closing them
+        return results
+    finally:
+        values_shm.close()
+        present_shm.close()
+
+
+def calculate_metrics_sharded(panel, columns=METRIC_COLUMNS, n_workers: int = None) -> pd.DataFrame:
+    n_workers = n_workers or workers()
+    shards = population_shards(panel, n_workers * SHARDS_PER_WORKER)
+    value_columns = list(panel.values)
+    shape = (len(value_columns), len(panel), len(panel.ages))
+
+    values_shm = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(shape)) * 8))
+    present_shm = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(shape[1:]))))
+    try:
+        values = np.ndarray(shape, dtype=np.float64, buffer=values_shm.buf)
+        for i, c in enumerate(value_columns): values[i] = panel[c]
+        np.ndarray(shape[1:], dtype=bool, buffer=present_shm.buf)[:] = panel.present
+        del values
+
+        # spawn: workers start clean instead of forking the parent's log listener thread
+        with ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+            futures = [pool.submit(metrics_shard, values_shm.name, present_shm.name, shape, value_columns,
+                                   panel.ages, start, stop, list(columns)) for start, stop in shards]
+            results = [f.result() for f in futures]
+    finally:
+        values_shm.close()
+        values_shm.unlink()
+        present_shm.close()
+        present_shm.unlink()
+
+    log.log(f"calculated metrics in {len(shards)} population shards on {n_workers} workers")
+    return panel.to_frame(**{c: np.concatenate([r[c] for r in results]) for c in columns})
+
+
+def compute_metrics(panel, columns=METRIC_COLUMNS) -> pd.DataFrame:
+    if workers() > 1:
+        if len(panel) >= shard_min_rows(): return calculate_metrics_sharded(panel, columns)
+        log.log(f"metrics computed in process, not on {workers()} workers: {len(panel)} country-years "
+                f"is below shard_min_rows ({shard_min_rows()})")
+    return calculate_metrics_for_panel(panel, columns)
+
+
+# (ISO3, ISO3_suffix, Year) as plain values, so keys from the panel and from a stored table compare equal
+def key_index(keys: pd.DataFrame) -> pd.MultiIndex:
+    return pd.MultiIndex.from_arrays([
+        keys["ISO3"].astype(str).to_numpy(),
+        keys["ISO3_suffix"].astype(object).fillna("").astype(str).to_numpy(),
+        keys["Year"].astype(int).to_numpy()])
+
+
+def calculate_metrics(life_table_df: pd.DataFrame, previous: pd.DataFrame = None, columns=METRIC_COLUMNS,
+                      populations=None, cy_id=None) -> pd.DataFrame:
+    '''
+    per country-year metrics (H_N, T, Ne, mx skew/kurtosis, B/M/Z/PrR) from one panel of the life table,
+    with a fingerprint of the lx/mx values of every country-year, indexed by cy_id
+
+    previous: an earlier result of this function (same columns); country-years whose fingerprint is
+    unchanged take their metrics from it, only new or changed country-years are computed
+    populations, cy_id: registry of the life table (see build_panel)
+    '''
+    panel = build_panel(life_table_df, columns=PANEL_COLUMNS, populations=populations, cy_id=cy_id)
+    return calculate_panel_metrics(panel, previous, columns)
+
+
+def calculate_panel_metrics(panel: LifeTablePanel, previous: pd.DataFrame = None, columns=METRIC_COLUMNS) -> pd.DataFrame:
+    ''' calculate_metrics of a panel with (at least) PANEL_COLUMNS, e.g. from the binary panel store '''
+    fingerprint = panel.fingerprints()
+
+    # previous results come from another run, their ids differ, so they are matched on the keys
+    changed = np.ones(len(panel), dtype=bool)
+    if previous is not None and len(previous):
+        idx = key_index(previous).get_indexer(key_index(panel.keys))
+        found = idx >= 0
+        changed[found] = previous["fingerprint"].to_numpy()[idx[found]] != fingerprint[found]
+
+    rows = np.flatnonzero(changed)
+    values = {c: np.full(len(panel), np.nan) for c in columns}
+    if len(rows):
+        computed = compute_metrics(panel.subset(rows), columns)
+        for c in columns: values[c][rows] = computed[c].to_numpy()
+    if len(rows) < len(panel):
+        reused = np.flatnonzero(~changed)
+        for c in columns: values[c][reused] = previous[c].to_numpy()[idx[reused]]
+
+    log.log(f"calculated {len(columns)} metrics for {len(rows)} country-years, reused {len(panel) - len(rows)} unchanged")
+    return panel.to_frame(fingerprint=fingerprint, **values)
@@ -0,0 +1,127 @@
+import hashlib
+import numpy as np
+import pandas as pd
+from dataclasses import dataclass, field
+from src.python.helper import get_settings
+from src.python import log
+from src.python.population import index_populations
+
+
+
+@dataclass
+class LifeTablePanel:
+    """
+    Dense (country-year x age) view of a life table.
+
+    keys    : one row per country-year (ISO3, ISO3_suffix, Year), in panel row order
+    cy_id   : country-year id per row (src/python/population.py), pop_id: population id per row
+    ages    : age grid min_age..max_age, one column per age
+    offsets : start of every country-year in the sorted life table (len = groups + 1)
+    order   : row positions of the life table sorted by country-year and age
+    present : True where the life table has a row for that country-year and age
+    values  : float64 (groups x ages) arrays per column, NaN where not present
+    """
+    keys: pd.DataFrame
+    ages: np.ndarray
+    offsets: np.ndarray
+    order: np.ndarray
+    present: np.ndarray
+    values: dict = field(default_factory=dict)
+    cy_id: np.ndarray = None
+    pop_id: np.ndarray = None
+
+    def __len__(self): return len(self.keys)
+
+    def __getitem__(self, column) -> np.ndarray: return self.values[column]
+
+    @property
+    def lengths(self) -> np.ndarray: return self.present.sum(axis=1)
+
+    def packed(self, column) -> np.ndarray:
+        '''
+        left-align a column so that position i is the i-th age present in each country-year,
+        i.e. the same layout as looping over each group sorted by age
+        '''
+        values = self.values[column]
+        if self._is_contiguous(): return values
+
+        out = np.full_like(values, np.nan)
+        rank = np.cumsum(self.present, axis=1) - 1
+        rows, cols = np.nonzero(self.present)
+        out[rows, rank[rows, cols]] = values[rows, cols]
+        return out
+
+    def subset(self, rows: np.ndarray) -> "LifeTablePanel":
+        ''' panel of the given country-year rows only (same age grid) '''
+        starts, ends = self.offsets[:-1][rows], self.offsets[1:][rows]
+        offsets = np.zeros(len(starts) + 1, dtype=np.int64)
+        np.cumsum(ends - starts, out=offsets[1:])
+        positions = np.repeat(starts - offsets[:-1], ends - starts) + np.arange(offsets[-1])
+        return LifeTablePanel(
+            self.keys.iloc[rows].reset_index(drop=True), self.ages, offsets, self.order[positions],
+            self.present[rows], {c: v[rows] for c, v in self.values.items()}, self.cy_id[rows], self.pop_id[rows])
+
+    def fingerprints(self, columns=("lx", "mx")) -> np.ndarray:
+        '''
+        hex digest per country-year of the ages present and the values of columns,
+        equal fingerprints mean identical inputs to the metrics
+        '''
+        data = np.concatenate([self.present.astype(np.float64), *(self.values[c] for c in columns)], axis=1)
+        return np.array([hashlib.blake2b(row.tobytes(), digest_size=8).hexdigest() for row in data], dtype=object)
+
+    def to_frame(self, **results) -> pd.DataFrame:
+        ''' attach per country-year results (1-D arrays in panel row order) to the keys, indexed by cy_id '''
+        return self.keys.assign(**results).set_axis(pd.Index(self.cy_id, name="cy_id"))
+
+    def _is_contiguous(self) -> bool:
+        # every country-year covers the grid from the first age without gaps
+        cols = np.arange(len(self.ages))
+        return bool(np.array_equal(self.present, cols[None, :] < self.lengths[:, None]))
+
+
+def build_panel(life_table_df: pd.DataFrame, columns=("lx", "mx"), populations=None, cy_id=None) -> LifeTablePanel:
+    '''
+    populations, cy_id: the registry of the life table and the country-year id of each of its rows
+    (population.index_populations), built here when not given
+    '''
+    ages = np.arange(get_settings()["min_age"], get_settings()["max_age"] + 1)
+    if populations is None: populations, (cy_id,) = index_populations(life_table_df)
+
+    # keep only ages on the grid
+    in_grid = life_table_df["Age"].between(ages[0], ages[-1]).to_numpy()
+    if not in_grid.all():
+        log.warn(f"panel: dropped {int((~in_grid).sum())} rows with ages outside {ages[0]}..{ages[-1]}")
+    df = life_table_df.loc[in_grid, ["Age", *[c for c in columns if c != "Age"]]]
+
+    # one sort by country-year and age (cy_id order is key order)
+    age_idx = (df["Age"].to_numpy() - ages[0]).astype(np.intp)
+    cy_id = np.asarray(cy_id)[in_grid]
+    order = np.lexsort((age_idx, cy_id))
+    cy_id, age_idx = cy_id[order], age_idx[order]
+
+    # panel rows are the country-years that have rows
+    starts = np.flatnonzero(np.r_[True, cy_id[1:] != cy_id[:-1]]) if len(cy_id) else np.zeros(0, dtype=np.int64)
+    group = np.cumsum(np.r_[False, cy_id[1:] != cy_id[:-1]]) if len(cy_id) else np.zeros(0, dtype=np.int64)
+    n_groups = len(starts)
+    offsets = np.r_[starts, len(cy_id)].astype(np.int64)
+
+    present = np.zeros((n_groups, len(ages)), dtype=bool)
+    present[group, age_idx] = True
+    if present.sum() != len(group):
+        log.warn(f"panel: {len(group) - int(present.sum())} duplicated country-year-age rows, keeping the last")
+
+    values = {}
+    for column in columns:
+        arr = np.full((n_groups, len(ages)), np.nan, dtype=np.float64)
+        arr[group, age_idx] = pd.to_numeric(df[column], errors="coerce").to_numpy(dtype=np.float64)[order]
+        values[column] = arr
+
+    row_cy = cy_id[starts]
+    keys = populations.keys(row_cy)
+
+    # order refers to positions in the original life table
+    order = np.flatnonzero(in_grid)[order]
+
+    log.log(f"built life table panel: {n_groups} country-years x {len(ages)} ages")
+    return LifeTablePanel(keys, ages, offsets, order, present, values,
+                          row_cy, populations.country_years["pop_id"].to_numpy()[row_cy])
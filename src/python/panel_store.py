@@ -0,0 +1,140 @@
+import os, json, shutil
+import numpy as np
+import pandas as pd
+from src.python import log
+from src.python.panel import LifeTablePanel
+from src.python.population import PopulationIndex
+
+
+# binary panel cache of the life table: next to life_table.<ext> the life table stage writes life_table_panel/
+# with one .npy array (country-years x ages) per column, the ages present, and the population id and year of
+# every row. rows are sorted by population and year, so one population (and a year range of it) is a contiguous
+# block; arrays are opened with np.load(mmap_mode="r"), a slice only reads the pages it covers
+
+PANEL_FOLDER = "life_table_panel"
+META_FILE = "meta.json"
+STORE_COLUMNS = {"lx": "float64", "mx": "float64", "ex": "float32", "K": "float32", # as in LIFE_TABLE_SCHEMA
+                 "dx": "float64", "sx": "float64", "vx": "float64", "N": "float64"} # derivatives read by the metrics
+
+
+def panel_folder(life_table_path: str) -> str: return os.path.join(os.path.dirname(life_table_path), PANEL_FOLDER)
+
+
+def write_panel_store(panel: LifeTablePanel, populations: PopulationIndex, folder: str) -> str:
+    '''
+    write a panel built by build_panel (with the STORE_COLUMNS it has) to folder, returns folder
+    '''
+    tmp = folder + ".tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+
+    columns = [c for c in STORE_COLUMNS if c in panel.values]
+    np.save(os.path.join(tmp, "present.npy"), panel.present)
+    np.save(os.path.join(tmp, "pop_id.npy"), panel.pop_id.astype(np.int32))
+    np.save(os.path.join(tmp, "year.npy"), panel.keys["Year"].to_numpy(dtype=np.int16))
+    for column in columns:
+        np.save(os.path.join(tmp, f"{column}.npy"), panel.values[column].astype(STORE_COLUMNS[column]))
+    with open(os.path.join(tmp, META_FILE), "w") as f:
+        json.dump({"min_age": int(panel.ages[0]), "max_age": int(panel.ages[-1]), "columns": columns,
+                   "iso3": populations.populations["ISO3"].tolist(),
+                   "suffix": populations.populations["ISO3_suffix"].tolist()}, f)
+
+    shutil.rmtree(folder, ignore_errors=True)
+    os.replace(tmp, folder)
+    log.log(f"wrote life table panel: {len(panel)} country-years x {len(panel.ages)} ages, {', '.join(columns)}")
+    return folder
+
+
+class PanelStore:
+    '''
+    memory-mapped life table panel written by write_panel_store
+
+    select(iso3=..., years=(first, last), ages=(first, last)) returns views of the rows and ages asked for,
+    frame(...) the same as a long table like the life table, panel() a LifeTablePanel for the metrics
+    '''
+
+    def __init__(self, folder: str):
+        with open(os.path.join(folder, META_FILE)) as f:
+            meta = json.load(f)
+        self.folder = folder
+        self.ages = np.arange(meta["min_age"], meta["max_age"] + 1)
+        self.columns = meta["columns"]
+        self.populations = pd.DataFrame({"ISO3": meta["iso3"], "ISO3_suffix": meta["suffix"]})
+        self.population_ids = {(iso3, suffix): i for i, (iso3, suffix) in enumerate(zip(meta["iso3"], meta["suffix"]))}
+        self.pop_id = self.load("pop_id")
+        self.year = self.load("year")
+        self.present = self.load("present")
+
+    def __len__(self): return len(self.pop_id)
+
+    def load(self, name: str) -> np.ndarray: return np.load(os.path.join(self.folder, f"{name}.npy"), mmap_mode="r")
+
+    def __getitem__(self, column) -> np.ndarray:
+        ''' the whole (country-years x ages) array of a column, memory-mapped '''
+        if column not in self.columns: raise KeyError(f"{column} is not in the life table panel ({', '.join(self.columns)})")
+        return self.load(column)
+
+    def rows(self, iso3: str = None, suffix: str = "", years: tuple = None):
+        '''
+        rows of a population (iso3, suffix) as a slice, optionally within years (first, last) inclusive;
+        without iso3 every population's rows in the year range (an index array)
+        '''
+        if iso3 is None:
+            if years is None: return slice(0, len(self))
+            return np.flatnonzero((self.year >= years[0]) & (self.year <= years[1]))
+
+        pop = self.population_ids.get((iso3.strip().upper(), suffix or ""))
+        if pop is None: return slice(0, 0)
+        start, stop = np.searchsorted(self.pop_id, [pop, pop + 1]) # binary search, reads a few pages
+        if years is not None:
+            first, last = np.searchsorted(self.year[start:stop], [years[0], years[1] + 1])
+            start, stop = start + first, start + last
+        return slice(int(start), int(stop))
+
+    def age_columns(self, ages: tuple = None) -> slice:
+        ''' columns of the ages (first, last) inclusive '''
+        if ages is None: return slice(0, len(self.ages))
+        return slice(max(int(ages[0] - self.ages[0]), 0), max(int(ages[1] - self.ages[0]) + 1, 0))
+
+    def select(self, iso3: str = None, suffix: str = "", years: tuple = None, ages: tuple = None, columns=None) -> dict:
+        '''
+        {column: (rows x ages) array} for one population and/or a year range and/or an age band,
+        plus "Year", "pop_id" (per row), "Age" (per column) and "present"; views into the files where the rows are a slice
+        '''
+        rows, cols = self.rows(iso3, suffix, years), self.age_columns(ages)
+        out = {c: self[c][rows, cols] for c in (columns or self.columns)}
+        out.update(present=self.present[rows, cols], Year=self.year[rows], pop_id=self.pop_id[rows], Age=self.ages[cols])
+        return out
+
+    def frame(self, iso3: str = None, suffix: str = "", years: tuple = None, ages: tuple = None, columns=None) -> pd.DataFrame:
+        ''' the selection as a long table (ISO3, ISO3_suffix, Year, Age and columns), one row per age present '''
+        data = self.select(iso3, suffix, years, ages, columns)
+        rows, cols = np.nonzero(data["present"])
+        populations = self.populations.iloc[np.asarray(data["pop_id"])[rows]]
+        return pd.DataFrame({
+            "ISO3": populations["ISO3"].to_numpy(),
+            "ISO3_suffix": populations["ISO3_suffix"].to_numpy(),
+            "Year": np.asarray(data["Year"])[rows],
+            "Age": data["Age"][cols],
+            **{c: data[c][rows, cols] for c in (columns or self.columns)},
+        })
+
+    def registry(self) -> PopulationIndex:
+        ''' population registry of the stored rows (cy_id = row) '''
+        return PopulationIndex(self.populations, pd.DataFrame({"pop_id": np.asarray(self.pop_id), "Year": np.asarray(self.year)}))
+
+    def panel(self, columns=("lx", "mx")) -> LifeTablePanel:
+        ''' LifeTablePanel of all rows for the metrics, columns memory-mapped ("Age" is filled in from the grid) '''
+        present = np.asarray(self.present)
+        offsets = np.zeros(len(self) + 1, dtype=np.int64)
+        np.cumsum(present.sum(axis=1), out=offsets[1:])
+        values = {c: np.where(present, self.ages.astype(np.float64), np.nan) if c == "Age" else self[c] for c in columns}
+        return LifeTablePanel(
+            self.registry().keys(), self.ages, offsets, np.arange(offsets[-1]), present, values,
+            np.arange(len(self), dtype=np.int32), np.asarray(self.pop_id))
+
+
+def open_panel_store(life_table_path: str):
+    ''' the panel store written next to a life table, None if there is none (e.g. a life table from an older run) '''
+    folder = panel_folder(life_table_path)
+    return PanelStore(folder) if os.path.exists(os.path.join(folder, META_FILE)) else None
@@ -0,0 +1,79 @@
+import numpy as np
+import pandas as pd
+from dataclasses import dataclass
+
+
+# population registry: every (ISO3, ISO3_suffix) gets an int32 pop_id and every (population, Year) an int32 cy_id,
+# computed once from the key columns (string work only on the unique labels, never per row).
+# ids are sorted by ISO3, suffix and year, so cy_id order is the usual key sort order; modules join, group and
+# index on the ids and the string keys are only materialised for the tables that are written.
+# ids are only valid within one registry (one run), tables that are kept across runs (the metrics cache) use the keys
+
+KEYS = ["ISO3", "ISO3_suffix", "Year"]
+
+
+@dataclass
+class PopulationIndex:
+    populations: pd.DataFrame # ISO3, ISO3_suffix ("" for none) per pop_id
+    country_years: pd.DataFrame # pop_id, Year per cy_id
+
+    def __len__(self): return len(self.country_years)
+
+    def keys(self, cy_id=None) -> pd.DataFrame:
+        ''' ISO3, ISO3_suffix, Year of the given country-years (default: all, in cy_id order) '''
+        cy = self.country_years if cy_id is None else self.country_years.iloc[cy_id]
+        populations = self.populations.iloc[cy["pop_id"].to_numpy()]
+        return pd.DataFrame({
+            "ISO3": populations["ISO3"].to_numpy(),
+            "ISO3_suffix": populations["ISO3_suffix"].to_numpy(),
+            "Year": cy["Year"].to_numpy(),
+        })
+
+
+def labels(values, upper: bool = False) -> tuple:
+    '''
+    codes of values into their sorted unique labels (strings, "" for missing, upper cased and stripped with upper),
+    string work is done on the uniques only (categorical columns are not expanded)
+    '''
+    codes, uniques = pd.factorize(values, use_na_sentinel=False)
+    names = pd.Series(np.asarray(uniques, dtype=object)).fillna("").astype(str)
+    if upper: names = names.str.strip().str.upper()
+    names = names.to_numpy(dtype=str)
+    names, inverse = np.unique(names, return_inverse=True) # also merges labels equal after normalising
+    return inverse[codes], names
+
+
+def sorted_ids(key: np.ndarray) -> tuple:
+    ''' dense ids of int64 keys numbered in key order, and the sorted unique keys '''
+    codes, uniques = pd.factorize(key)
+    order = np.argsort(uniques, kind="stable")
+    rank = np.empty(len(uniques), dtype=np.int32)
+    rank[order] = np.arange(len(uniques), dtype=np.int32)
+    return rank[codes], uniques[order]
+
+
+def index_populations(*frames: pd.DataFrame) -> tuple:
+    '''
+    registry of the populations and country-years in the KEYS columns of frames,
+    returns (PopulationIndex, [cy_id per row of each frame])
+    '''
+    parts = [(labels(df["ISO3"], upper=True), labels(df["ISO3_suffix"]), df["Year"].to_numpy(dtype=np.int64)) for df in frames]
+
+    # shared label tables, then per row codes into them
+    iso3_names = np.unique(np.concatenate([iso3[1] for iso3, _, _ in parts]))
+    suffix_names = np.unique(np.concatenate([suffix[1] for _, suffix, _ in parts]))
+    iso3 = np.concatenate([np.searchsorted(iso3_names, names)[codes] for (codes, names), _, _ in parts]).astype(np.int64)
+    suffix = np.concatenate([np.searchsorted(suffix_names, names)[codes] for _, (codes, names), _ in parts]).astype(np.int64)
+    year = np.concatenate([y for _, _, y in parts])
+
+    pop_id, pop_keys = sorted_ids(iso3 * len(suffix_names) + suffix)
+    first_year = year.min() if len(year) else 0
+    span = int(year.max() - first_year) + 1 if len(year) else 1
+    cy_id, cy_keys = sorted_ids(pop_id.astype(np.int64) * span + (year - first_year))
+
+    index = PopulationIndex(
+        populations=pd.DataFrame({"ISO3": iso3_names[pop_keys // len(suffix_names)],
+                                  "ISO3_suffix": suffix_names[pop_keys % len(suffix_names)]}),
+        country_years=pd.DataFrame({"pop_id": (cy_keys // span).astype(np.int32), "Year": cy_keys % span + first_year}))
+    bounds = np.cumsum([0, *(len(df) for df in frames)])
+    return index, [cy_id[start:stop] for start, stop in zip(bounds[:-1], bounds[1:])]
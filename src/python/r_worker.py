@@ -0,0 +1,132 @@
+import os, time, atexit, shutil, threading, subprocess
+from dataclasses import dataclass
+from src.python.helper import R_PATH, get_settings
+from src.python import log
+
+
+# R scripts run in long-lived R processes (src/R/worker.R) instead of one Rscript each: R and data.table start
+# once per worker and the worker keeps the tables it read (src/R/table_io.R). a worker runs one script at a time;
+# scripts given the same share key (main.py: the life table they read) queue for one worker, so the table is read
+# once, other scripts running concurrently (src/python/scheduler.py) each get an idle or new worker
+
+WORKER_R = os.path.join(R_PATH, "worker.R")
+WINDOWS_R = (r"C:\Program Files\R", r"C:\Program Files (x86)\R") # default install folders, for r_version
+STOP_TIMEOUT = 10
+
+
+def rscript() -> str:
+    ''' Rscript on the PATH, else the Windows install of r_version from settings.json5 '''
+    found = shutil.which("Rscript")
+    if found: return found
+
+    version = get_settings().get("r_version")
+    for root in WINDOWS_R:
+        path = os.path.join(root, version or "", "bin", "Rscript.exe")
+        if version and os.path.exists(path): return path
+    log.error(f"Rscript not found on the PATH or in {' / '.join(WINDOWS_R)}\\{version}\\bin (r_version in settings.json5)")
+
+
+@dataclass
+class ScriptResult:
+    script: str
+    ok: bool
+    seconds: float # time spent in the script, as measured by R
+    output: list # lines printed by the script, messages and warnings included
+    error: str = None
+
+
+class RWorker:
+    ''' one R process running the scripts it is sent over stdin, see src/R/worker.R for the protocol '''
+
+    def __init__(self):
+        started = time.perf_counter()
+        self.process = subprocess.Popen([rscript(), WORKER_R], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                        text=True, bufsize=1) # stderr goes to the console
+        if self.process.stdout.readline().strip() != "ready":
+            self.stop()
+            log.error(f"R worker failed to start (exit {self.process.returncode})")
+        log.log(f"started R worker (pid {self.process.pid}) in {time.perf_counter() - started:.2f}s")
+
+    def run(self, script: str, *args) -> ScriptResult:
+        request = "\t".join(["run", script, *map(str, args)])
+        try:
+            self.process.stdin.write(request + "\n")
+            self.process.stdin.flush()
+        except OSError: # broken pipe, the worker is gone
+            pass
+
+        header = self.process.stdout.readline()
+        if not header:
+            log.error(f"R worker exited while running {os.path.basename(script)} (exit {self.process.wait()})")
+        status, seconds, n, error = header.rstrip("\r\n").split("\t", 3)
+        output = [self.process.stdout.readline().rstrip("\r\n") for _ in range(int(n))]
+        return ScriptResult(script, status == "ok", float(seconds), output, error or None)
+
+    def stop(self):
+        if self.process.poll() is None:
+            try:
+                self.process.stdin.write("quit\n")
+                self.process.stdin.close()
+                self.process.wait(STOP_TIMEOUT)
+            except (OSError, subprocess.TimeoutExpired):
+                self.process.kill()
+                self.process.wait()
+
+
+idle = []
+workers = []
+shared = {} # share key -> worker of the scripts with that key
+share_locks = {} # share key -> lock held while one of its scripts runs
+workers_lock = threading.Lock()
+
+
+def start() -> RWorker:
+    worker = RWorker()
+    with workers_lock:
+        if not workers: atexit.register(stop)
+        workers.append(worker)
+    return worker
+
+
+def acquire() -> RWorker:
+    with workers_lock:
+        if idle: return idle.pop()
+    return start()
+
+
+def run_in(worker: RWorker, script: str, args: tuple) -> ScriptResult:
+    try:
+        return worker.run(script, *args)
+    except BaseException:
+        worker.stop() # state unknown, not reused
+        raise
+
+
+def run_script(script: str, *args, share: str = None) -> ScriptResult:
+    '''
+    run an R script with args as its command line arguments in an idle (or new) worker, or with share
+    in the worker of that key, after the scripts of the key already running or waiting
+    '''
+    if share is None:
+        worker = acquire()
+        result = run_in(worker, script, args)
+        with workers_lock:
+            idle.append(worker)
+        return result
+
+    with workers_lock:
+        lock = share_locks.setdefault(share, threading.Lock())
+    with lock:
+        worker = shared.get(share)
+        if worker is None or worker.process.poll() is not None: worker = shared[share] = start()
+        return run_in(worker, script, args)
+
+
+def stop():
+    ''' stop all workers, done at exit '''
+    with workers_lock:
+        for worker in workers: worker.stop()
+        workers.clear()
+        idle.clear()
+        shared.clear()
+        share_locks.clear()
@@ -0,0 +1,112 @@
+import time
+import pandas as pd
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from src.python import log, instrument
+
+
+# small DAG scheduler for main.py: a stage declares the artifacts (tables, file paths) it takes and produces,
+# it starts as soon as all its inputs exist, so independent stages (e.g. the HMD/HFD/HG/WBLG loads) run
+# concurrently in threads. threads rather than processes because stages hand dataframes to each other; the heavy
+# parts release the GIL (pandas/numpy kernels, file io, Rscript subprocesses, the metrics process pool).
+# wall times come from the instrument records; stages that overlap are marked there (overlapped), cpu_s is per thread
+
+
+@dataclass
+class Stage:
+    name: str
+    run: callable # run(**inputs) returns the outputs: a single value, or a tuple in the order of outputs
+    inputs: tuple = ()
+    outputs: tuple = ()
+
+
+def producers(stages: list) -> dict:
+    ''' artifact -> name of the stage that outputs it '''
+    return {output: s.name for s in stages for output in s.outputs}
+
+
+def select(stages: list, only=None, start=None) -> list:
+    '''
+    stages to run: the named ones (only, a list of names), or start and every stage downstream of it; default all
+    '''
+    names = {s.name for s in stages}
+    for name in (only or []) + ([start] if start else []):
+        if name not in names: log.error(f"unknown stage: {name} (stages: {', '.join(s.name for s in stages)})")
+
+    if only: return [s for s in stages if s.name in only]
+    if not start: return list(stages)
+
+    # downstream closure: a stage is selected once one of its inputs comes from a selected stage
+    selected, produced = {start}, set()
+    for s in stages: # stages are listed in dependency order
+        if s.name in selected or any(i in produced for i in s.inputs):
+            selected.add(s.name)
+            produced.update(s.outputs)
+    return [s for s in stages if s.name in selected]
+
+
+def missing_inputs(stages: list) -> list:
+    ''' inputs that no stage in stages produces (e.g. upstream of --from), in first use order '''
+    produced = producers(stages)
+    return list(dict.fromkeys(i for s in stages for i in s.inputs if i not in produced))
+
+
+def execute(stage: Stage, inputs: dict):
+    with instrument.stage(stage.name) as record:
+        result = stage.run(**inputs)
+        outputs = (result,) if len(stage.outputs) == 1 else result or ()
+        if len(stage.outputs) == 1 and isinstance(result, pd.DataFrame): record.rows_out = len(result)
+    return dict(zip(stage.outputs, outputs)), record
+
+
+def run(stages: list, artifacts: dict = None, workers: int = None) -> dict:
+    '''
+    run stages as their inputs become available (artifacts: inputs already at hand), returns all artifacts;
+    workers limits how many stages run at once (default: no limit)
+    '''
+    artifacts = dict(artifacts or {})
+    pending = list(stages)
+    records = {}
+    started = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=workers or max(len(stages), 1)) as pool:
+        running = {}
+        while pending or running:
+            for s in [s for s in pending if all(i in artifacts for i in s.inputs)]:
+                running[pool.submit(execute, s, {i: artifacts[i] for i in s.inputs})] = s
+                pending.remove(s)
+            if not running:
+                log.error("stages waiting on inputs nothing produces: " + ", ".join(
+                    f"{s.name} ({', '.join(i for i in s.inputs if i not in artifacts)})" for s in pending))
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                s = running.pop(future)
+                outputs, records[s.name] = future.result() # a failed stage raises here, running ones still finish
+                artifacts.update(outputs)
+
+    summary(stages, records, time.perf_counter() - started)
+    return artifacts
+
+
+def critical_path(stages: list, records: dict) -> list:
+    ''' longest chain of dependent stages by wall time, the lower bound of the run time with unlimited parallelism '''
+    produced = producers(stages)
+    finish, previous = {}, {}
+    for s in stages: # dependency order
+        upstream = [produced[i] for i in s.inputs if i in produced]
+        previous[s.name] = max(upstream, key=finish.get, default=None)
+        finish[s.name] = records[s.name].wall_s + (finish[previous[s.name]] if previous[s.name] else 0)
+
+    path = [max(finish, key=finish.get)] if finish else []
+    while path and previous[path[-1]]: path.append(previous[path[-1]])
+    return path[::-1]
+
+
+def summary(stages: list, records: dict, wall: float):
+    path = critical_path(stages, records)
+    total = sum(r.wall_s for r in records.values())
+    log.log(f"scheduler: {len(records)} stages in {wall:.2f}s wall, {total:.2f}s of stage time "
+            f"({total / wall if wall else 0:.1f}x overlap)")
+    log.log("critical path: " + " -> ".join(f"{name} {records[name].wall_s:.2f}s" for name in path)
+            + f" = {sum(records[name].wall_s for name in path):.2f}s")
@@ -0,0 +1,46 @@
+import pandas as pd
+from src.python import log
+
+
+# declared column types for the tables handed between stages
+# keys are repeated on every row, so they are categorical; lx/mx stay float64 as the metrics are computed from them
+LIFE_TABLE_SCHEMA = {
+    "ISO3": "category",
+    "ISO3_suffix": "category",
+    "Year": "int16",
+    "Age": "int16",
+    "K": "float32", # radix scale survivorship, whole numbers up to 100,000 are exact in float32
+    "ex": "float32",
+    "lx": "float64",
+    "mx": "float64",
+}
+
+COUNTRY_TABLE_SCHEMA = {
+    "ISO3": "category",
+    "ISO3_suffix": "category",
+    "Year": "int16",
+    "IS": "category",
+    "H_N": "float64",
+}
+
+
+def memory_mb(df: pd.DataFrame) -> float: return df.memory_usage(deep=True).sum() / 1e6
+
+
+def apply_schema(df: pd.DataFrame, schema: dict, name: str) -> pd.DataFrame:
+    '''
+    cast the columns of df that appear in schema, and log memory usage before and after
+    '''
+    before = memory_mb(df)
+
+    dtypes = {}
+    for column, dtype in schema.items():
+        if column not in df.columns: continue
+        if dtype.startswith("int") and df[column].isna().any():
+            log.warn(f"{name}: {column} has missing values, cannot store it as {dtype}")
+            continue
+        dtypes[column] = dtype
+    df = df.astype(dtypes)
+
+    log.log(f"applied {name} schema: {before:.1f} MB -> {memory_mb(df):.1f} MB")
+    return df
@@ -0,0 +1,112 @@
+import os, json, glob, pickle, shutil, hashlib
+import pandas as pd
+from src.python.helper import get_settings
+from src.python.download import file_sha256
+from src.python import log
+
+
+# stage cache: every stage result is stored under data/cache/<stage>-<key>, with key a sha256 of the stage's
+# inputs (raw files, upstream tables), the settings it reads and the source files of the code that computes it.
+# a rerun with the same key loads the stored result instead of recomputing it; only the latest entry per stage is kept
+
+CACHE_FOLDER = "data/cache"
+
+
+def enabled() -> bool: return get_settings().get("stage_cache", True)
+
+
+def hash_path(path: str) -> str:
+    '''
+    sha256 of a file, or of every file under a directory (names and contents, partial downloads skipped)
+    '''
+    if os.path.isfile(path): return file_sha256(path)
+
+    h = hashlib.sha256()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            if name.endswith(".part"): continue
+            file = os.path.join(root, name)
+            h.update(os.path.relpath(file, path).encode())
+            h.update(file_sha256(file).encode())
+    return h.hexdigest()
+
+
+def hash_frame(df: pd.DataFrame) -> str:
+    ''' sha256 of a dataframe's columns, dtypes and values (row order matters, the index does not) '''
+    h = hashlib.sha256()
+    h.update(json.dumps([[str(c), str(t)] for c, t in df.dtypes.items()]).encode())
+    h.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+    return h.hexdigest()
+
+
+def stage_key(stage: str, *inputs: str, settings=(), sources=()) -> str:
+    '''
+    cache key of a stage from its input hashes, the values of the settings it reads and its source files
+    '''
+    h = hashlib.sha256(stage.encode())
+    for digest in inputs: h.update(digest.encode())
+    h.update(json.dumps({s: get_settings().get(s) for s in settings}, sort_keys=True).encode())
+    for source in sources: h.update(file_sha256(source).encode())
+    return h.hexdigest()
+
+
+def entry_path(stage: str, key: str, ext: str) -> str: return os.path.join(CACHE_FOLDER, f"{stage}-{key[:16]}{ext}")
+
+
+# drop older entries of a stage once a new one is stored
+def prune(stage: str, keep: str):
+    for path in glob.glob(os.path.join(CACHE_FOLDER, f"{stage}-*")):
+        if path != keep: os.remove(path)
+
+
+def load(stage: str, key: str):
+    ''' stored result of stage for key, None if there is none '''
+    path = entry_path(stage, key, ".pkl")
+    if not enabled() or not os.path.exists(path): return None
+    with open(path, "rb") as f:
+        return pickle.load(f)
+
+
+def store(stage: str, key: str, result):
+    if not enabled(): return
+    path = entry_path(stage, key, ".pkl")
+    os.makedirs(CACHE_FOLDER, exist_ok=True)
+    with open(path + ".tmp", "wb") as f:
+        pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(path + ".tmp", path)
+    prune(stage, path)
+
+
+def cached(stage: str, key: str, compute):
+    '''
+    return the stored result of stage for key, or compute() it and store it
+    '''
+    result = load(stage, key)
+    if result is not None:
+        log.log(f"{stage}: inputs unchanged, reusing cached result ({key[:16]})")
+        return result
+
+    result = compute()
+    store(stage, key, result)
+    return result
+
+
+def cached_file(stage: str, key: str, output: str, run):
+    '''
+    for stages that write a file (e.g. the R scripts updating the country table in place):
+    copy the stored output to output, or run() and store a copy of what it wrote
+    '''
+    path = entry_path(stage, key, os.path.splitext(output)[1])
+    if enabled() and os.path.exists(path):
+        shutil.copyfile(path, output)
+        log.log(f"{stage}: inputs unchanged, reusing cached output ({key[:16]})")
+        return
+
+    run()
+
+    if enabled():
+        os.makedirs(CACHE_FOLDER, exist_ok=True)
+        shutil.copyfile(output, path + ".tmp")
+        os.replace(path + ".tmp", path)
+        prune(stage, path)
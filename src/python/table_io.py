@@ -0,0 +1,58 @@
+import os
+import pandas as pd
+from src.python.helper import get_settings, get_out_path, run_folders
+from src.python import log
+
+
+# intermediate tables are stored as csv, parquet or feather (arrow ipc), chosen by output_format in settings.json5
+EXTENSIONS = {"csv": ".csv", "parquet": ".parquet", "feather": ".feather"}
+
+
+def output_format() -> str:
+    fmt = get_settings().get("output_format", "csv")
+    if fmt not in EXTENSIONS:
+        log.error(f"unsupported output_format in settings: {fmt} (expected one of {', '.join(EXTENSIONS)})")
+    return fmt
+
+
+def write_table(df: pd.DataFrame, name: str, folder=None) -> str:
+    '''
+    write df as <folder>/<name>.<ext> (default: this run's output folder) in the configured format, returns the path;
+    with export_csv a .csv copy is written next to parquet/feather output
+    '''
+    fmt = output_format()
+    folder = folder or get_out_path()
+    path = os.path.join(folder, name + EXTENSIONS[fmt])
+
+    if fmt == "parquet": df.to_parquet(path, index=False)
+    elif fmt == "feather": df.reset_index(drop=True).to_feather(path)
+    else: df.to_csv(path, index=False)
+
+    if fmt != "csv" and get_settings().get("export_csv", False):
+        df.to_csv(os.path.join(folder, name + ".csv"), index=False)
+
+    return path
+
+
+def read_table(path: str, columns=None, dtype=None) -> pd.DataFrame:
+    '''
+    read a table written by write_table, the format follows the file extension;
+    columns projects the read, dtype only applies to csv (parquet/feather keep their types)
+    '''
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".parquet": return pd.read_parquet(path, columns=columns)
+    if ext in (".feather", ".arrow"): return pd.read_feather(path, columns=columns)
+    return pd.read_csv(path, usecols=columns, dtype=dtype)
+
+
+def previous_table(name: str) -> str:
+    '''
+    path of table name in the latest earlier run folder that has it (any format), None if no run has it
+    '''
+    current = get_out_path()
+    for _, folder in run_folders(os.path.dirname(current)):
+        if os.path.samefile(folder, current): continue
+        for ext in EXTENSIONS.values():
+            path = os.path.join(folder, name + ext)
+            if os.path.exists(path): return path
+    return None
@@ -0,0 +1,19 @@
+import os, shutil
+import pytest
+from src.python import helper, log, instrument
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(autouse=True)
+def workdir(tmp_path, monkeypatch):
+    ''' run every test in its own folder with the repo's settings.json5, so data/ and the log go there '''
+    shutil.copy(os.path.join(REPO, helper.SETTINGS_FILE), tmp_path)
+    monkeypatch.chdir(tmp_path)
+    helper.get_settings.cache_clear()
+    helper.run_out_path.cache_clear()
+    instrument.records.clear()
+    yield tmp_path
+    log.stop()
+    helper.get_settings.cache_clear()
+    helper.run_out_path.cache_clear()
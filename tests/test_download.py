@@ -0,0 +1,169 @@
+import os, socket, threading
+import pytest
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from src.python import download, log
+
+
+BODY = bytes(range(256)) * 256 # 64 KiB
+
+
+class Handler(BaseHTTPRequestHandler):
+    ''' static file with an ETag: If-None-Match (304), Range with If-Range (206), drop_after cuts the body short once, fail answers with that status '''
+    body = BODY
+    etag = '"v1"'
+    drop_after = None
+    fail = None
+    requests = [] # (headers, status) per request
+
+    def do_GET(self):
+        if self.fail:
+            type(self).requests.append((dict(self.headers), self.fail))
+            self.send_error(self.fail)
+            return
+        start = 0
+        if self.headers.get("If-None-Match") == self.etag:
+            status = 304
+        elif self.headers.get("Range") and self.headers.get("If-Range") == self.etag:
+            start = int(self.headers["Range"].removeprefix("bytes=").rstrip("-"))
+            status = 206 if start < len(self.body) else 416
+        else:
+            status = 200
+        type(self).requests.append((dict(self.headers), status))
+
+        self.send_response(status)
+        self.send_header("ETag", self.etag)
+        if status in (304, 416):
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        data = self.body[start:]
+        if status == 206: self.send_header("Content-Range", f"bytes {start}-{len(self.body) - 1}/{len(self.body)}")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+
+        if self.drop_after is not None: # connection lost mid transfer
+            data, type(self).drop_after = data[:self.drop_after], None
+        self.wfile.write(data)
+        self.wfile.flush()
+
+    def log_message(self, *args): pass
+
+
+@pytest.fixture
+def server():
+    Handler.body, Handler.etag, Handler.drop_after, Handler.fail, Handler.requests = BODY, '"v1"', None, None, []
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}/lt_female.zip"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def read(path):
+    with open(path, "rb") as f: return f.read()
+
+
+def test_fetch_downloads_and_records_cache_entry(server):
+    path = os.path.join(download.DOWNLOAD_FOLDER, "lt_female.zip")
+    assert download.fetch(download.make_session(), server, path) == len(BODY)
+    assert read(path) == BODY
+    assert not os.path.exists(path + ".part")
+
+    entry = download.load_cache()[server]
+    assert entry["etag"] == '"v1"'
+    assert entry["size"] == len(BODY)
+    assert entry["sha256"] == download.file_sha256(path)
+
+
+def test_second_fetch_is_not_modified(server):
+    path = os.path.join(download.DOWNLOAD_FOLDER, "lt_female.zip")
+    session = download.make_session()
+    download.fetch(session, server, path)
+    modified = os.path.getmtime(path)
+
+    assert download.fetch(session, server, path) == 0
+    headers, status = Handler.requests[-1]
+    assert headers["If-None-Match"] == '"v1"'
+    assert status == 304
+    assert read(path) == BODY
+    assert os.path.getmtime(path) == modified
+
+
+def test_changed_content_is_downloaded_again(server):
+    path = os.path.join(download.DOWNLOAD_FOLDER, "lt_female.zip")
+    session = download.make_session()
+    download.fetch(session, server, path)
+
+    Handler.body, Handler.etag = BODY[::-1], '"v2"'
+    assert download.fetch(session, server, path) == len(BODY)
+    assert Handler.requests[-1][1] == 200
+    assert read(path) == BODY[::-1]
+    assert download.load_cache()[server]["etag"] == '"v2"'
+
+
+def test_interrupted_download_resumes(server, monkeypatch):
+    monkeypatch.setattr(download, "CHUNK_SIZE", 1024) # chunks smaller than the cut, so part of the body reaches the .part file
+    path = os.path.join(download.DOWNLOAD_FOLDER, "lt_female.zip")
+    session = download.make_session()
+
+    Handler.drop_after = 20000
+    with pytest.raises(log.PipelineError, match="download failed from"):
+        download.fetch(session, server, path)
+    received = os.path.getsize(path + ".part")
+    assert 0 < received < len(BODY)
+    assert not os.path.exists(path)
+
+    assert download.fetch(session, server, path) == len(BODY) - received
+    headers, status = Handler.requests[-1]
+    assert headers["Range"] == f"bytes={received}-"
+    assert headers["If-Range"] == '"v1"'
+    assert status == 206
+    assert read(path) == BODY
+    assert not os.path.exists(path + ".part")
+    assert "partial" not in download.load_cache()[server]
+
+
+def test_changed_content_restarts_interrupted_download(server, monkeypatch):
+    monkeypatch.setattr(download, "CHUNK_SIZE", 1024)
+    path = os.path.join(download.DOWNLOAD_FOLDER, "lt_female.zip")
+    session = download.make_session()
+
+    Handler.drop_after = 20000
+    with pytest.raises(log.PipelineError, match="download failed from"):
+        download.fetch(session, server, path)
+
+    Handler.body, Handler.etag = BODY[::-1], '"v2"' # If-Range no longer matches, the server sends everything
+    assert download.fetch(session, server, path) == len(BODY)
+    assert Handler.requests[-1][1] == 200
+    assert read(path) == BODY[::-1]
+
+
+def test_http_error_names_the_url(server):
+    Handler.fail = 404
+    with pytest.raises(log.PipelineError, match=f"download failed from {server}: 404"):
+        download.fetch(download.make_session(), server, os.path.join(download.DOWNLOAD_FOLDER, "lt_female.zip"))
+
+
+def test_connection_error_names_the_url():
+    with socket.socket() as s: # a port nothing listens on
+        s.bind(("127.0.0.1", 0))
+        url = f"http://127.0.0.1:{s.getsockname()[1]}/asfr.zip"
+    session = download.make_session()
+    session.mount("http://", download.HTTPAdapter(max_retries=0)) # no backoff between attempts
+    with pytest.raises(log.PipelineError, match=f"download failed from {url}"):
+        download.fetch(session, url, os.path.join(download.DOWNLOAD_FOLDER, "asfr.zip"))
+
+
+def test_login_page_error_names_the_site(server):
+    Handler.fail = 404
+    session = download.make_session()
+    with pytest.raises(log.PipelineError, match=f"could not open the HMD login page {server}"):
+        download.login(session, server, "HMD")
+
+
+def test_download_all_raises_pipeline_error(server):
+    Handler.fail = 404
+    path = os.path.join(download.DOWNLOAD_FOLDER, "lt_female.zip")
+    with pytest.raises(log.PipelineError, match=server):
+        download.download_all({"HMD": lambda: download.fetch(download.make_session(), server, path)})
@@ -0,0 +1,177 @@
+import numpy as np
+import pandas as pd
+import pytest
+from pandas.testing import assert_frame_equal
+from src.python import hmd, hfd
+from src.python.hxd import read_hxd, split_population_code, HMD_DTYPES, HFD_DTYPES
+
+
+# format_hmd / format_hfd against the implementations they replaced (before the vectorised edge-row dropping),
+# copied below with the setting passed in. intended differences, both from grouping on (ISO3, ISO3_suffix, Year):
+#   - the old HMD grouped on (ISO3, Year) only, so populations sharing an ISO3 (DEUTE, DEUTW) lost one 110+ row
+#     between them instead of one each
+#   - the old HFD grouped on "ISO3_suffixYear" (a missing comma) and raised a KeyError without edge data; with the
+#     key corrected groupby dropped every population without a suffix (NA suffix), so it is compared with dropna=False
+
+pytestmark = pytest.mark.filterwarnings("ignore:DataFrameGroupBy.apply operated on the grouping columns:FutureWarning") # old code
+
+
+def old_format_hmd(df: pd.DataFrame, include_edge_data: bool) -> pd.DataFrame:
+    hmd_variables = ["PopName", "Year", "Age", "lx", "ex"]
+    df = df[hmd_variables].copy()
+    df["PopName"], df["ISO3_suffix"] = split_population_code(df["PopName"])
+    df.rename(columns={"PopName": "ISO3"}, inplace=True)
+
+    df.rename(columns={"lx": "K"}, inplace=True)
+    df["K"] = pd.to_numeric(df["K"], errors="coerce")
+
+    base0 = (
+    df.loc[df["Age"] == 0, ["ISO3", "ISO3_suffix", "Year", "K"]].rename(columns={"K": "K0"}))
+    df = df.merge(base0, on=["ISO3", "ISO3_suffix", "Year"], how="left")
+    df["lx"] = df["K"] / df["K0"]
+    df.drop(columns="K0", inplace=True)
+
+    if include_edge_data == False:
+        df = (
+            df.groupby(["ISO3", "Year"], group_keys=False, observed=True)
+            .apply(lambda g: g.iloc[:-1])
+        )
+    return df
+
+
+def old_format_hfd(df: pd.DataFrame, include_edge_data: bool) -> pd.DataFrame:
+    df.rename(columns={"Code": "ISO3", "ASFR": "mx"}, inplace=True)
+    df["ISO3"], df["ISO3_suffix"] = split_population_code(df["ISO3"])
+
+    if include_edge_data == False:
+        df = (
+            df.groupby(["ISO3", "ISO3_suffix", "Year"], group_keys=False, observed=True, dropna=False) # key corrected
+            .apply(lambda g: g.iloc[1:-1])
+        )
+    return df
+
+
+HMD_AGES = ["0", "1", "2", "3", "110+"]
+HFD_AGES = ["12-", "13", "14", "54", "55+"]
+
+
+def write_hmd(path):
+    ''' HMD fltper_1x1 layout: SWE, DEUTE and DEUTW (same ISO3), NZL_NM, 2 years; NZL_NM 2001 has no age 0 '''
+    rows = []
+    for code in ["SWE", "DEUTE", "DEUTW", "NZL_NM"]:
+        for year in [2000, 2001]:
+            ages = HMD_AGES[1:] if (code, year) == ("NZL_NM", 2001) else HMD_AGES
+            lx = 100000
+            for i, age in enumerate(ages):
+                rows.append(f"{code:>8}{year:>6}{age:>6}  0.01  0.01  0.50{lx:>8}  {100 + i}  99000  5000000  {80.5 - i:.2f}")
+                lx -= 1000 * (i + 1) + len(code) + year % 7
+    with open(path, "w") as f:
+        f.write("Female life tables (period 1x1)\n\n")
+        f.write("  PopName  Year   Age        mx       qx    ax      lx      dx      Lx       Tx     ex\n")
+        f.write("\n".join(rows) + "\n")
+
+
+def write_hfd(path):
+    ''' HFD asfrRR layout: USA, GBRTENW and GBR_SCO, 2 years, ages 12- to 55+ '''
+    rows = []
+    for code in ["USA", "GBRTENW", "GBR_SCO"]:
+        for year in [2000, 2001]:
+            for i, age in enumerate(HFD_AGES):
+                asfr = "." if (code, year, age) == ("USA", 2001, "14") else f"{0.001 * (i + 1) + len(code) / 1e4:.5f}"
+                rows.append(f"{code:>8}{year:>6}{age:>6}{asfr:>10}")
+    with open(path, "w") as f:
+        f.write("Age-specific fertility rate, registered births, resident mothers\n\n")
+        f.write("     Code  Year   Age      ASFR\n")
+        f.write("\n".join(rows) + "\n")
+
+
+@pytest.fixture
+def hmd_df(tmp_path):
+    write_hmd(tmp_path / "fltper_1x1.txt")
+    return read_hxd(tmp_path / "fltper_1x1.txt", HMD_DTYPES)
+
+
+@pytest.fixture
+def hfd_df(tmp_path):
+    write_hfd(tmp_path / "asfrRR.txt")
+    return read_hxd(tmp_path / "asfrRR.txt", HFD_DTYPES)
+
+
+def set_edge_data(monkeypatch, module, include_edge_data: bool):
+    monkeypatch.setattr(module, "get_settings", lambda: {"include_edge_data": include_edge_data})
+
+
+def file_order(df: pd.DataFrame) -> pd.DataFrame: return df.sort_index().reset_index(drop=True)
+
+
+def population(df: pd.DataFrame, iso3: str, suffix=None) -> pd.DataFrame:
+    same = df["ISO3_suffix"].isna() if suffix is None else df["ISO3_suffix"].eq(suffix)
+    return df[df["ISO3"].eq(iso3) & same]
+
+
+def test_hmd_with_edge_data_matches_old(monkeypatch, hmd_df):
+    set_edge_data(monkeypatch, hmd, True)
+    new = hmd.format_hmd(hmd_df.copy())
+    assert_frame_equal(file_order(new), file_order(old_format_hmd(hmd_df.copy(), True)))
+
+    assert new["Age"].max() == 110 # 110+ parsed to 110
+    assert new["lx"][new["Age"].eq(0)].eq(1).all()
+    assert population(new, "NZL", "_NM").query("Year == 2001")["lx"].isna().all() # no age 0, no base
+
+
+def test_hmd_without_edge_data(monkeypatch, hmd_df):
+    set_edge_data(monkeypatch, hmd, False)
+    new = file_order(hmd.format_hmd(hmd_df.copy()))
+    old = file_order(old_format_hmd(hmd_df.copy(), False))
+
+    # every population is alone on its ISO3 except DEUTE/DEUTW: same rows as before
+    for iso3, suffix in [("SWE", None), ("NZL", "_NM")]:
+        assert_frame_equal(population(new, iso3, suffix).reset_index(drop=True), population(old, iso3, suffix).reset_index(drop=True))
+
+    # intended difference: each country-year loses its own 110+ row, the old code kept DEUTE's (grouped with DEUTW)
+    assert not new["Age"].eq(110).any()
+    assert population(old, "DEU", "TE")["Age"].eq(110).sum() == 2
+    assert population(old, "DEU", "TW")["Age"].eq(110).sum() == 0
+    for suffix in ["TE", "TW"]:
+        assert len(population(new, "DEU", suffix)) == 2 * (len(HMD_AGES) - 1)
+    assert len(new) == len(hmd_df) - 8
+
+
+def test_hfd_with_edge_data_matches_old(monkeypatch, hfd_df):
+    set_edge_data(monkeypatch, hfd, True)
+    new = hfd.format_hfd(hfd_df.copy())
+    assert_frame_equal(file_order(new), file_order(old_format_hfd(hfd_df.copy(), True)))
+    assert sorted(new["Age"].unique()) == [12, 13, 14, 54, 55] # 12- and 55+ parsed
+    assert population(new, "USA")["mx"].isna().sum() == 1 # "." is missing
+
+
+def test_hfd_without_edge_data(monkeypatch, hfd_df):
+    set_edge_data(monkeypatch, hfd, False)
+    new = file_order(hfd.format_hfd(hfd_df.copy()))
+    assert_frame_equal(new, file_order(old_format_hfd(hfd_df.copy(), False)))
+
+    # the 12- and 55+ rows of every country-year are gone, suffixed populations included
+    assert set(new["Age"]) == {13, 14, 54}
+    assert len(new) == 3 * 2 * (len(HFD_AGES) - 2)
+    assert set(new["ISO3_suffix"].dropna()) == {"TENW", "_SCO"}
+
+
+def test_missing_age_and_code_stay_missing(tmp_path):
+    # "." is a missing value in HxD files: a missing age must not take another row's age, nor a missing code another population
+    with open(tmp_path / "fltper_1x1.txt", "w") as f:
+        f.write("Female life tables (period 1x1)\n\n")
+        f.write("  PopName  Year   Age        mx       qx    ax      lx      dx      Lx       Tx     ex\n")
+        f.write("     AUS  2000     0  0.01  0.01  0.50  100000  100  99000  5000000  80.50\n")
+        f.write("   DEUTE  2000  110+  0.01  0.01  0.50   99000  101  99000  5000000  79.50\n")
+        f.write("   DEUTE  2000     .  0.01  0.01  0.50   98000  102  99000  5000000  78.50\n")
+        f.write("       .  2000     1  0.01  0.01  0.50   97000  103  99000  5000000  77.50\n")
+    df = read_hxd(tmp_path / "fltper_1x1.txt", HMD_DTYPES)
+    np.testing.assert_array_equal(df["Age"].to_numpy(dtype=float), [0, 110, np.nan, 1])
+
+    iso3, suffix = split_population_code(df["PopName"])
+    assert iso3.tolist()[:3] == ["AUS", "DEU", "DEU"] and pd.isna(iso3[3])
+    assert pd.isna(suffix[0]) and suffix.tolist()[1:3] == ["TE", "TE"] and pd.isna(suffix[3])
+
+
+def test_ages_stay_int16_without_missing_values(hmd_df):
+    assert hmd_df["Age"].dtype == np.int16
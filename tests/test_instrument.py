@@ -0,0 +1,81 @@
+import json, os, threading, time
+import numpy as np
+import pytest
+from src.python import instrument
+from src.python.helper import get_out_path
+
+
+def busy(seconds: float):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end: pass
+
+
+def run_metrics() -> dict:
+    with open(os.path.join(get_out_path(), instrument.METRICS_FILE)) as f:
+        return {s["stage"]: s for s in json.load(f)["stages"]}
+
+
+def test_stage_alone_is_not_overlapped():
+    with instrument.stage("alone"):
+        busy(0.2)
+    record = run_metrics()["alone"]
+    assert not record["overlapped"]
+    assert record["cpu_s"] >= 0.1
+    assert record["children_cpu_s"] is not None
+
+
+def test_overlapping_stages_are_marked_and_cpu_is_per_thread():
+    started = threading.Barrier(2)
+    def idle_stage():
+        with instrument.stage("idle"):
+            started.wait()
+            time.sleep(0.3)
+    thread = threading.Thread(target=idle_stage)
+    thread.start()
+    with instrument.stage("busy"):
+        started.wait()
+        busy(0.3)
+    thread.join()
+
+    records = run_metrics()
+    assert records["idle"]["overlapped"] and records["busy"]["overlapped"]
+    assert records["idle"]["children_cpu_s"] is None and records["busy"]["children_cpu_s"] is None
+    assert records["idle"]["cpu_s"] < 0.1 # the busy stage's cpu is not counted in the sleeping one
+    assert records["busy"]["cpu_s"] >= 0.15
+
+
+def test_nested_stage_in_the_same_thread_is_not_overlapped():
+    with instrument.stage("outer"):
+        with instrument.stage("inner"):
+            busy(0.05)
+    records = run_metrics()
+    assert not records["outer"]["overlapped"] and not records["inner"]["overlapped"]
+
+
+needs_vm_hwm = pytest.mark.skipif(not (instrument.vm_hwm_mb() and os.access(instrument.CLEAR_REFS, os.W_OK)), reason="no resettable VmHWM")
+
+
+@needs_vm_hwm
+def test_peak_rss_is_per_stage():
+    with instrument.stage("large"):
+        large = np.ones(50_000_000) # 400 MB
+        del large
+    with instrument.stage("small"):
+        small = np.ones(1_000_000)
+        del small
+    records = run_metrics()
+    assert records["large"]["peak_rss_mb"] > 350
+    assert records["small"]["peak_rss_mb"] < records["large"]["peak_rss_mb"] - 300 # not the process peak
+    assert records["small"]["process_peak_rss_mb"] >= records["large"]["peak_rss_mb"]
+
+
+@needs_vm_hwm
+def test_nested_stage_keeps_the_outer_peak():
+    with instrument.stage("outer"):
+        large = np.ones(50_000_000)
+        del large
+        with instrument.stage("inner"): # resets the high-water mark
+            pass
+    records = run_metrics()
+    assert records["outer"]["peak_rss_mb"] > 350
+    assert records["inner"]["peak_rss_mb"] < records["outer"]["peak_rss_mb"] - 300
@@ -0,0 +1,87 @@
+import numpy as np
+import pandas as pd
+from numpy.testing import assert_allclose
+from src.python.life_table_derivatives import add_life_table_derivatives, DERIVED_COLUMNS
+
+
+def r_life_table_derivatives(df: pd.DataFrame) -> pd.DataFrame:
+    ''' literal port of src/R/life_table_derivatives.R: groups from paste(ISO3, ISO3_suffix, Year), loops as written there '''
+    df = df.copy()
+    for column in DERIVED_COLUMNS: df[column] = np.nan
+    df["N"] = df["lx"] * 1000
+
+    groups = {}
+    for i, key in enumerate(df["ISO3"].astype(str) + ":" + df["ISO3_suffix"].astype(str) + ":" + df["Year"].astype(str)):
+        groups.setdefault(key, []).append(i)
+
+    column = {c: df.columns.get_loc(c) for c in DERIVED_COLUMNS}
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for g in groups.values():
+            n_group = len(g)
+            if n_group < 2: continue
+
+            lx = df["lx"].to_numpy(dtype=float)[g]
+            mx = df["mx"].to_numpy(dtype=float)[g]
+
+            dx = np.array([1 - lx[i + 1] / lx[i] for i in range(n_group - 1)])
+            sx = 1 - dx
+            df.iloc[g[:-1], column["dx"]] = dx
+            df.iloc[g[:-1], column["sx"]] = sx
+
+            lxmx_raw = lx * mx
+            lxmx = np.where(np.isnan(lxmx_raw), 0, lxmx_raw)
+            lxmx_SUM = np.sum(lxmx)
+            lxmx_STAND = lxmx / lxmx_SUM
+            mx_ADJ = lxmx_STAND / lx
+            df.iloc[g, column["lxmx"]] = lxmx
+            df.iloc[g, column["mx_ADJ"]] = mx_ADJ
+            df.iloc[g, column["lxmx_STAND"]] = lxmx_STAND
+
+            lxmx_STAND_SUM_qx = np.array([np.sum(lxmx_STAND[i:n_group]) for i in range(n_group)])
+            df.iloc[g, column["lxmx_STAND_SUM_qx"]] = lxmx_STAND_SUM_qx
+
+            vx = np.array([lxmx_STAND_SUM_qx[i + 1] ** 2 / lx[i + 1] ** 2 for i in range(n_group - 1)])
+            df.iloc[g[:-1], column["vx"]] = vx
+    return df
+
+
+def life_table_fixture() -> pd.DataFrame:
+    '''
+    a few country-years: a plain one, a suffixed population next to the unsuffixed one, a year with a missing mx,
+    one with lx reaching 0 at the last age, a single-row country-year (skipped) and rows of two country-years interleaved
+    '''
+    rows = []
+    def country_year(iso3, suffix, year, lx, mx):
+        rows.extend({"ISO3": iso3, "ISO3_suffix": suffix, "Year": year, "Age": 12 + i, "lx": l, "mx": m}
+                    for i, (l, m) in enumerate(zip(lx, mx)))
+
+    country_year("AUS", "", 2000, [1.0, 0.99, 0.97, 0.94, 0.90], [0.0001, 0.02, 0.08, 0.11, 0.05])
+    country_year("NZL", "", 2000, [1.0, 0.995, 0.985, 0.97], [0.001, 0.03, 0.09, 0.04])
+    country_year("NZL", "_NM", 2000, [1.0, 0.99, 0.98, 0.96], [0.002, 0.04, 0.07, 0.03])
+    country_year("NZL", "_NM", 2001, [1.0, 0.99, 0.98, 0.96], [0.002, np.nan, 0.07, 0.03])
+    country_year("SWE", "", 2000, [1.0, 0.5, 0.1, 0.0], [0.01, 0.05, 0.02, 0.01])
+    country_year("USA", "", 2000, [1.0], [0.01])
+    df = pd.DataFrame(rows)
+
+    # interleave the rows of AUS and NZL 2000, order within each country-year unchanged
+    aus, nzl = df.index[df["ISO3"].eq("AUS")], df.index[df["ISO3"].eq("NZL") & df["ISO3_suffix"].eq("")]
+    order = [i for pair in zip(aus, nzl) for i in pair] + list(aus[len(nzl):]) + [i for i in df.index if i not in aus and i not in nzl]
+    return df.loc[order].reset_index(drop=True)
+
+
+def test_derivatives_match_r_script():
+    df = life_table_fixture()
+    expected = r_life_table_derivatives(df)
+    actual = add_life_table_derivatives(df)
+
+    assert list(actual.columns) == list(expected.columns)
+    for column in DERIVED_COLUMNS:
+        assert_allclose(actual[column].to_numpy(dtype=float), expected[column].to_numpy(dtype=float),
+                        rtol=1e-12, atol=0, err_msg=column)
+
+
+def test_single_row_country_year_is_skipped():
+    actual = add_life_table_derivatives(life_table_fixture())
+    usa = actual[actual["ISO3"].eq("USA")]
+    assert usa["N"].tolist() == [1000.0]
+    assert usa[[c for c in DERIVED_COLUMNS if c != "N"]].isna().all(axis=None)
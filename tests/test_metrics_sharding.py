@@ -0,0 +1,62 @@
+import numpy as np
+import pandas as pd
+import pytest
+from src.python import metrics
+from src.python.life_table_derivatives import add_life_table_derivatives
+from src.python.panel import build_panel
+
+
+def life_table(populations=("AUS", "DEUTE", "DEUTW", "NZL_NM", "SWE", "USA"), years=range(2000, 2003)) -> pd.DataFrame:
+    ''' synthetic life table over ages 0..110: falling lx, fertility (mx) at ages 12..55 '''
+    rng = np.random.default_rng(0)
+    ages = np.arange(0, 111)
+    frames = []
+    for code in populations:
+        for year in years:
+            lx = np.cumprod(1 - rng.uniform(0.001, 0.05, len(ages)))
+            mx = np.where((ages >= 12) & (ages <= 55), rng.uniform(0.001, 0.12, len(ages)), np.nan)
+            frames.append(pd.DataFrame({"ISO3": code[:3], "ISO3_suffix": code[3:], "Year": year, "Age": ages, "lx": lx / lx[0], "mx": mx}))
+    return add_life_table_derivatives(pd.concat(frames, ignore_index=True))
+
+
+@pytest.fixture
+def panel():
+    return build_panel(life_table(), columns=metrics.PANEL_COLUMNS)
+
+
+def set_settings(monkeypatch, **settings):
+    monkeypatch.setattr(metrics, "get_settings", lambda: settings)
+
+
+def test_small_panel_is_computed_in_process_and_logged(monkeypatch, panel):
+    set_settings(monkeypatch, workers=2, shard_min_rows=len(panel) + 1)
+    messages = []
+    monkeypatch.setattr(metrics.log, "log", messages.append)
+    monkeypatch.setattr(metrics, "calculate_metrics_sharded", lambda *args, **kwargs: pytest.fail("sharded below shard_min_rows"))
+
+    metrics.compute_metrics(panel)
+    assert any("not on 2 workers" in m and f"shard_min_rows ({len(panel) + 1})" in m for m in messages)
+
+
+def test_one_worker_is_not_logged(monkeypatch, panel):
+    set_settings(monkeypatch, workers=1, shard_min_rows=0)
+    messages = []
+    monkeypatch.setattr(metrics.log, "log", messages.append)
+    monkeypatch.setattr(metrics, "calculate_metrics_sharded", lambda *args, **kwargs: pytest.fail("sharded with one worker"))
+
+    metrics.compute_metrics(panel)
+    assert not any("shard_min_rows" in m for m in messages)
+
+
+def test_sharded_metrics_equal_in_process(monkeypatch, panel):
+    expected = metrics.calculate_metrics_for_panel(panel)
+    set_settings(monkeypatch, workers=2, shard_min_rows=0)
+    pd.testing.assert_frame_equal(metrics.compute_metrics(panel), expected)
+
+
+def test_shards_only_split_between_populations(panel):
+    shards = metrics.population_shards(panel, 4)
+    assert shards[0][0] == 0 and shards[-1][1] == len(panel)
+    for (_, stop), (start, _) in zip(shards[:-1], shards[1:]):
+        assert stop == start
+        assert panel.pop_id[start] != panel.pop_id[start - 1]